@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Measure what @logs, @parse_gpt and inject add to Passthrough.read/write.
+
+Drives passthrough.Passthrough (the baseline) and passthrough_logging.Passthrough directly, without
+a FUSE mount, against a synthetic GPT disk image. Prints one JSON object per (config, pattern).
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+
+import cache
+import gpt
+import injector
+import logger
+import overlay
+import passthrough
+import passthrough_logging
+import stats
+
+LBA = 512
+IMAGE_NAME = 'disk.img'
+
+# name: (call, block size, sequential)
+PATTERNS = {
+    'seq_read_4k': ('read', 4 << 10, True),
+    'seq_read_128k': ('read', 128 << 10, True),
+    'rand_read_4k': ('read', 4 << 10, False),
+    'rand_read_128k': ('read', 128 << 10, False),
+    'seq_write_4k': ('write', 4 << 10, True),
+    'rand_write_4k': ('write', 4 << 10, False),
+}
+
+# name: extra passthrough_logging arguments ({dir} is the per-config scratch dir); None is the plain Passthrough
+CONFIGS = {
+    'baseline': None,
+    'file': ['--log_file', '{dir}/log.txt'],
+    'db': ['--log_db', '{dir}/log.db'],
+    'db_bytes': ['--log_db', '{dir}/log.db', '--log_bytes'],
+    'db_hash': ['--log_db', '{dir}/log.db', '--log_hash'],
+    'db_async': ['--log_db', '{dir}/log.db', '--log_hash', '--log_async'],
+    'db_workers': ['--log_db', '{dir}/log.db', '--log_bytes', '--compress', 'zlib', '--log_async',
+                   '--hash_workers', '4'],
+    'trace': ['--log_trace', '{dir}/log.trace', '--log_hash'],
+    'db_diff': ['--log_db', '{dir}/log.db', '--log_bytes', '--write_diff_block', '4096'],
+    'db_coalesce': ['--log_db', '{dir}/log.db', '--log_hash', '--coalesce_ms', '50'],
+    'overlay': ['--log_file', '{dir}/log.txt', '--overlay_dir', '{dir}/overlay'],
+    'cache': ['--log_file', '{dir}/log.txt', '--cache_size', str(32 << 20)],
+}
+
+
+def make_gpt_image(path, size, num_partitions=8, fill=True):
+    """Write a disk image with a valid (CRC-checked) primary and backup GPT and evenly sized partitions"""
+    num_lbas = size // LBA
+    entries = b''
+    first_usable, last_usable = 34, num_lbas - 34
+    part_lbas = (last_usable - first_usable) // num_partitions
+    for i in range(num_partitions):
+        first = first_usable + i * part_lbas
+        name = ('PART%i' % i).encode('utf-16-le')
+        entries += struct.pack('<16s16sQQQ72s', uuid.uuid4().bytes_le, uuid.uuid4().bytes_le,
+                               first, first + part_lbas - 1, 0, name)
+    entries = entries.ljust(128 * 128, b'\0')
+
+    def header(current, backup, entries_lba):
+        raw = struct.pack('<8s4sII4xQQQQ16sQIII', b'EFI PART', b'\x00\x00\x01\x00', 92, 0, current, backup,
+                          first_usable, last_usable, uuid.uuid4().bytes_le, entries_lba, 128, 128,
+                          zlib.crc32(entries))
+        return raw[:16] + struct.pack('<I', zlib.crc32(raw)) + raw[20:]
+
+    with open(path, 'wb') as fh:
+        fh.truncate(size)
+        if fill:
+            # Distinct contents per block, so hashing and blob dedup see a realistic workload
+            chunk = os.urandom(1 << 20)
+            for pos in range(first_usable * LBA, last_usable * LBA, len(chunk)):
+                fh.seek(pos)
+                fh.write(chunk[:last_usable * LBA - pos])
+        fh.seek(LBA)
+        fh.write(header(1, num_lbas - 1, 2))
+        fh.seek(2 * LBA)
+        fh.write(entries)
+        fh.seek((num_lbas - 33) * LBA)
+        fh.write(entries)
+        fh.seek((num_lbas - 1) * LBA)
+        fh.write(header(num_lbas - 1, 1, num_lbas - 33))
+
+
+def offsets(size, block, sequential, ops, rng, start=0, end=None):
+    end = size if end is None else end
+    slots = (end - start) // block
+    for i in range(ops):
+        yield start + block * (i % slots if sequential else rng.randrange(slots))
+
+
+def setup(name, root, scratch, opts):
+    if CONFIGS[name] is None:
+        return passthrough.Passthrough(root)
+    argv = ['--root', root, '--config', opts.config] + [a.format(dir=scratch) for a in CONFIGS[name]]
+    args = passthrough_logging.make_parser().parse_args(argv)
+    gpt.init_gpt(args)
+    overlay.init_overlay(args)
+    cache.init_cache(args)
+    logger.init_logging(args)
+    injector.init_injector(args)
+    # Every config starts from an unparsed GPT
+    gpt.CACHE.written(0, 1)
+    return passthrough_logging.Passthrough(root, use_mmap=opts.mmap)
+
+
+def run_pattern(fs, pattern, opts, rng):
+    call, block, sequential = PATTERNS[pattern]
+    path = '/' + IMAGE_NAME
+    fh = fs.open(path, os.O_RDWR)
+    latencies = []
+    try:
+        if call == 'read':
+            places = offsets(opts.size, block, sequential, opts.ops, rng)
+            started = time.perf_counter()
+            for offset in places:
+                t = time.perf_counter()
+                fs.read(path, block, offset, fh)
+                latencies.append(time.perf_counter() - t)
+        else:
+            # Stay clear of both GPTs so writes don't invalidate the partition table
+            places = offsets(opts.size, block, sequential, opts.ops, rng, 1 << 20, opts.size - (1 << 20))
+            bufs = [os.urandom(block) for _ in range(16)]
+            started = time.perf_counter()
+            for i, offset in enumerate(places):
+                t = time.perf_counter()
+                fs.write(path, bufs[i % len(bufs)], offset, fh)
+                latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+    finally:
+        fs.release(path, fh)
+
+    result = {'pattern': pattern, 'ops': len(latencies), 'seconds': round(elapsed, 6),
+              'ops_per_s': round(len(latencies) / elapsed, 1),
+              'mb_per_s': round(len(latencies) * block / elapsed / (1 << 20), 2)}
+    result.update(stats.summarize(latencies))
+    return result
+
+
+def run(opts, out):
+    workdir = tempfile.mkdtemp(prefix='badusb-bench-')
+    try:
+        template = os.path.join(workdir, 'template.img')
+        make_gpt_image(template, opts.size)
+        for name in opts.configs:
+            scratch = os.path.join(workdir, name)
+            root = os.path.join(scratch, 'root')
+            os.makedirs(root)
+            shutil.copyfile(template, os.path.join(root, IMAGE_NAME))
+            fs = setup(name, root, scratch, opts)
+            try:
+                for pattern in opts.patterns:
+                    result = run_pattern(fs, pattern, opts, random.Random(opts.seed))
+                    result['config'] = name
+                    out.write(json.dumps(result) + '\n')
+                    out.flush()
+            finally:
+                # Time draining the loggers (the async writer may still hold queued records)
+                started = time.perf_counter()
+                logger.close_logging()
+                overlay.close_overlays()
+                out.write(json.dumps({'config': name, 'pattern': 'close',
+                                      'seconds': round(time.perf_counter() - started, 6)}) + '\n')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Benchmark Passthrough read/write overhead without a FUSE mount")
+    argp.add_argument('--size', type=int, default=64 << 20, help="Synthetic image size in bytes")
+    argp.add_argument('--ops', type=int, default=5000, help="Operations per pattern")
+    argp.add_argument('--seed', type=int, default=0, help="Seed for random offsets")
+    argp.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    argp.add_argument('--patterns', nargs='+', default=list(PATTERNS), choices=list(PATTERNS))
+    argp.add_argument('--mmap', action="store_true", help="Use the --mmap read path")
+    argp.add_argument('--config', default='config.json', help="Path to a config file")
+    argp.add_argument('-o', '--output', default=None, help="Write JSON lines here instead of stdout")
+
+    opts = argp.parse_args()
+    out = open(opts.output, 'w') if opts.output else sys.stdout
+    # Results go to out; GPT/injector chatter goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        run(opts, out)
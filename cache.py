@@ -0,0 +1,131 @@
+"""In-process LRU cache of fixed-size blocks read from backing images and replacement files.
+
+Blocks are keyed by (name, block number), where name is the file's absolute path, so the
+Passthrough read path and the injector sources share cached blocks. Only whole blocks are
+cached; the short block at the end of a file is always read from disk.
+"""
+
+import collections
+import threading
+
+import stats
+
+CACHE = None
+
+
+class BlockCache(object):
+    def __init__(self, budget, block_size=4096):
+        self.block_size = block_size
+        self.max_blocks = max(1, budget // block_size)
+        self.blocks = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Bumped by every invalidation; a miss only fills the cache if no write landed while it read
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def read(self, name, pread, fh, length, offset):
+        """pread(fh, length, offset), served from cached blocks where possible"""
+        if length <= 0:
+            return b''
+        bs = self.block_size
+        first, last = offset // bs, (offset + length - 1) // bs + 1
+        blocks = self.blocks
+        found = [None] * (last - first)
+        with self.lock:
+            generation = self.generation
+            for i in range(first, last):
+                data = blocks.get((name, i))
+                if data is not None:
+                    blocks.move_to_end((name, i))
+                    found[i - first] = data
+            missing = found.count(None)
+            self.hits += len(found) - missing
+            self.misses += missing
+
+        if missing:
+            # One aligned read per run of missing blocks
+            i = 0
+            while i < len(found):
+                if found[i] is not None:
+                    i += 1
+                    continue
+                j = i + 1
+                while j < len(found) and found[j] is None:
+                    j += 1
+                data = pread(fh, (j - i) * bs, (first + i) * bs)
+                for k in range(i, j):
+                    found[k] = data[(k - i) * bs:(k - i + 1) * bs]
+                i = j
+            self.fill(name, first, found, generation)
+
+        data = b''.join(found)
+        start = offset - first * bs
+        return data[start:start + length]
+
+    def fill(self, name, first, found, generation):
+        bs = self.block_size
+        blocks = self.blocks
+        with self.lock:
+            if generation != self.generation:
+                return
+            for i, data in enumerate(found):
+                if len(data) == bs:
+                    blocks[(name, first + i)] = data
+            while len(blocks) > self.max_blocks:
+                blocks.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name, offset, length):
+        bs = self.block_size
+        with self.lock:
+            self.generation += 1
+            for i in range(offset // bs, (offset + max(length, 1) - 1) // bs + 1):
+                if self.blocks.pop((name, i), None) is not None:
+                    self.invalidations += 1
+
+    def drop(self, name):
+        """Forget every block of a file (e.g. after a truncate)"""
+        with self.lock:
+            self.generation += 1
+            for key in [k for k in self.blocks if k[0] == name]:
+                del self.blocks[key]
+                self.invalidations += 1
+
+    def memory(self):
+        # Each block is a bytes object in an OrderedDict under a (name, number) key
+        return {'entries': len(self.blocks), 'bytes': len(self.blocks) * (self.block_size + 200),
+                'cap': self.max_blocks}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'blocks': len(self.blocks), 'bytes': len(self.blocks) * self.block_size,
+                'budget': self.max_blocks * self.block_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+def init_cache(args):
+    global CACHE
+    CACHE = BlockCache(args.cache_size, args.cache_block_size) if args.cache_size else None
+    if CACHE is not None:
+        stats.STATS.add_source('cache', CACHE.stats)
+        stats.STATS.add_memory('cache', CACHE.memory)
+
+
+def cached_read(name, pread, fh, length, offset):
+    if CACHE is None or name is None:
+        return pread(fh, length, offset)
+    return CACHE.read(name, pread, fh, length, offset)
+
+
+def invalidate(name, offset, length):
+    if CACHE is not None and name is not None:
+        CACHE.invalidate(name, offset, length)
+
+
+def drop(name):
+    if CACHE is not None:
+        CACHE.drop(name)
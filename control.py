@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Local control socket for a running mount.
+
+Clients connect to a Unix stream socket and send one command per line ("stats", ...); each gets
+one line of JSON back. Modules register the commands they answer with `command`.
+"""
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+
+COMMANDS = {}
+SERVER = None
+
+
+def command(name):
+    """Register the decorated function as the handler for `name`. It gets the command's arguments."""
+    def register(func):
+        COMMANDS[name] = func
+        return func
+    return register
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            words = line.decode('utf8').split()
+            if not words:
+                continue
+            func = COMMANDS.get(words[0])
+            if func is None:
+                reply = {'error': 'unknown command %r' % words[0], 'commands': sorted(COMMANDS)}
+            else:
+                try:
+                    reply = func(*words[1:])
+                except Exception as e:
+                    reply = {'error': '%s: %s' % (type(e).__name__, e)}
+            self.wfile.write(json.dumps(reply, default=str).encode('utf8') + b'\n')
+
+
+def serve(path):
+    """Start answering commands on a Unix socket at path from a background thread"""
+    global SERVER
+    if os.path.exists(path):
+        os.unlink(path)
+    SERVER = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    SERVER.daemon_threads = True
+    threading.Thread(target=SERVER.serve_forever, name="ControlSocket", daemon=True).start()
+    return SERVER
+
+
+def stop():
+    global SERVER
+    if SERVER is None:
+        return
+    SERVER.shutdown()
+    SERVER.server_close()
+    if os.path.exists(SERVER.server_address):
+        os.unlink(SERVER.server_address)
+    SERVER = None
+
+
+def send(path, line):
+    """Send one command to a running mount and return its decoded reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        fh = sock.makefile('rwb')
+        fh.write(line.encode('utf8') + b'\n')
+        fh.flush()
+        return json.loads(fh.readline().decode('utf8'))
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Send a command to a running mount's control socket")
+    argp.add_argument('socket', help="Path given to --control_socket")
+    argp.add_argument('command', nargs='+', help="Command and its arguments, e.g. stats")
+    args = argp.parse_args()
+    print(json.dumps(send(args.socket, ' '.join(args.command)), indent=2))
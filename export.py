@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Stream a --log_db capture out as NDJSON, CSV or per-column NumPy .npy/.npz files.
+
+Rows are fetched chunk_size at a time from a single read transaction, so memory use stays the same
+whatever the size of the capture. Filters are turned into a WHERE clause. The input can be a DB or
+the manifest of a rotated capture (its segments are exported in order, as one table).
+
+NumPy output needs no numpy: each column is written as a 1-d .npy array (int64, float64, or fixed
+width bytes sized by a MAX(LENGTH()) pre-query), NULLs becoming -1, NaN or empty.
+"""
+
+import argparse
+import array
+import contextlib
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zipfile
+
+TABLES = ('reads', 'writes', 'func_calls', 'extents', 'read_counts', 'rewrite_counts', 'blobs')
+FORMATS = ('ndjson', 'csv', 'npy', 'npz')
+
+# filter name -> candidate columns, first one present in the table is used
+FILTER_COLUMNS = {
+    'path': ('path',),
+    'partition': ('partition',),
+    'call': ('call',),
+    'offset': ('offset', 'start_offset'),
+}
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+def segments(path):
+    """The DB files making up a capture: the manifest's segments, in order, or just the DB"""
+    manifest = path if path.endswith('.manifest.json') else path + '.manifest.json'
+    if not os.path.exists(manifest):
+        return [path]
+    with open(manifest) as fh:
+        return [os.path.join(os.path.dirname(manifest), seg['path']) for seg in json.load(fh)['segments']]
+
+
+def table_columns(conn, table):
+    """[(name, declared type)] of a table"""
+    return [(row[1], row[2].upper()) for row in conn.execute("PRAGMA table_info(%s)" % table)]
+
+
+def where(names, filters):
+    """SQL WHERE clause (and its args) for the filters that apply to a table with these columns"""
+    clauses, args = [], []
+    for key, candidates in FILTER_COLUMNS.items():
+        column = next((c for c in candidates if c in names), None)
+        if column is None:
+            continue
+        if key == 'offset':
+            if filters.get('offset_min') is not None:
+                clauses.append('"%s" >= ?' % column)
+                args.append(filters['offset_min'])
+            if filters.get('offset_max') is not None:
+                clauses.append('"%s" < ?' % column)
+                args.append(filters['offset_max'])
+        elif key == 'partition' and filters.get(key) is not None:
+            # Requests spanning partitions are tagged with all of them, e.g. "A,B" (gpt.get_partitions)
+            clauses.append("instr(',' || \"%s\" || ',', ',' || ? || ',') > 0" % column)
+            args.append(filters[key])
+        elif filters.get(key) is not None:
+            clauses.append('"%s" = ?' % column)
+            args.append(filters[key])
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', args
+
+
+class Capture(object):
+    """A read-only view of one table across every segment of a capture"""
+    def __init__(self, path, table, filters=None):
+        self.paths = segments(path)
+        self.table = table
+        self.filters = filters or {}
+        self.conns = []
+        for p in self.paths:
+            conn = sqlite3.connect('file:%s?mode=ro' % p, uri=True)
+            # One snapshot per segment for the whole export, even while the mount keeps logging
+            conn.execute("BEGIN")
+            self.conns.append(conn)
+        self.columns = table_columns(self.conns[0], table)
+        self.names = [c[0] for c in self.columns]
+
+    def select(self, conn, expr):
+        clause, args = where(self.names, self.filters)
+        return conn.execute("SELECT %s FROM %s%s" % (expr, self.table, clause), args)
+
+    def chunks(self, chunk_size=10000):
+        """Lists of at most chunk_size row tuples"""
+        expr = ', '.join('"%s"' % n for n in self.names)
+        for conn in self.conns:
+            cur = self.select(conn, expr)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def count(self):
+        return sum(self.select(conn, 'COUNT(*)').fetchone()[0] for conn in self.conns)
+
+    def max_length(self, name):
+        return max(self.select(conn, 'MAX(LENGTH(CAST("%s" AS BLOB)))' % name).fetchone()[0] or 0
+                   for conn in self.conns)
+
+    def close(self):
+        for conn in self.conns:
+            conn.close()
+
+
+def jsonable(value):
+    return value.hex() if isinstance(value, bytes) else value
+
+
+def write_ndjson(capture, out, chunk_size=10000):
+    names = capture.names
+    for rows in capture.chunks(chunk_size):
+        out.write(''.join(json.dumps(dict(zip(names, map(jsonable, row)))) + '\n' for row in rows))
+
+
+def write_csv(capture, out, chunk_size=10000):
+    writer = csv.writer(out)
+    writer.writerow(capture.names)
+    for rows in capture.chunks(chunk_size):
+        writer.writerows([jsonable(v) for v in row] for row in rows)
+
+
+def npy_kind(decl_type):
+    """'i', 'f' or 'S' from a column's declared type (SQLite affinity rules)"""
+    if 'INT' in decl_type:
+        return 'i'
+    if any(t in decl_type for t in ('CHAR', 'CLOB', 'TEXT', 'BLOB')) or not decl_type:
+        return 'S'
+    return 'f'
+
+
+class NpyColumn(object):
+    """Streams one column into a .npy file whose shape and dtype are known up front"""
+    def __init__(self, path, kind, count, width=0):
+        self.kind = kind
+        self.width = max(width, 1)
+        descr = {'i': '<i8', 'f': '<f8', 'S': '|S%i' % self.width}[kind]
+        header = "{'descr': '%s', 'fortran_order': False, 'shape': (%i,), }" % (descr, count)
+        # Header padded so the data starts 64 byte aligned
+        header += ' ' * (-(len(NPY_MAGIC) + 2 + len(header) + 1) % 64) + '\n'
+        self.fh = open(path, 'wb')
+        self.fh.write(NPY_MAGIC + len(header).to_bytes(2, 'little') + header.encode('latin1'))
+
+    def write(self, values):
+        if self.kind == 'S':
+            width = self.width
+            data = b''.join((v if isinstance(v, bytes) else b'' if v is None else str(v).encode('utf8'))
+                            .ljust(width, b'\0') for v in values)
+        else:
+            data = array.array('q' if self.kind == 'i' else 'd',
+                               [(-1 if self.kind == 'i' else float('nan')) if v is None else v for v in values])
+            if sys.byteorder != 'little':
+                data.byteswap()
+        self.fh.write(data)
+
+    def close(self):
+        self.fh.close()
+
+
+def write_npy(capture, directory, chunk_size=10000):
+    """One <table>.<column>.npy per column in directory, in a single pass over the rows"""
+    os.makedirs(directory, exist_ok=True)
+    count = capture.count()
+    columns = []
+    for name, decl_type in capture.columns:
+        kind = npy_kind(decl_type)
+        width = capture.max_length(name) if kind == 'S' else 0
+        columns.append(NpyColumn(os.path.join(directory, '%s.%s.npy' % (capture.table, name)), kind, count, width))
+    try:
+        for rows in capture.chunks(chunk_size):
+            for i, column in enumerate(columns):
+                column.write([row[i] for row in rows])
+    finally:
+        for column in columns:
+            column.close()
+    return ['%s.%s.npy' % (capture.table, name) for name in capture.names]
+
+
+def write_npz(capture, filename, chunk_size=10000):
+    """The .npy columns bundled into one .npz (numpy.load(filename)['offset'] etc.)"""
+    tmp = tempfile.mkdtemp(prefix='badusb-export-', dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        files = write_npy(capture, tmp, chunk_size)
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            for name, f in zip(capture.names, files):
+                zf.write(os.path.join(tmp, f), name + '.npy')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def export(path, table, fmt, output=None, filters=None, chunk_size=10000):
+    """Export one table of a capture; output is a file (ndjson/csv/npz), a directory (npy), or stdout"""
+    capture = Capture(path, table, filters)
+    try:
+        if fmt in ('npy', 'npz'):
+            if not output:
+                raise ValueError("%s export needs an output path" % fmt)
+            (write_npy if fmt == 'npy' else write_npz)(capture, output, chunk_size)
+            return
+        with (open(output, 'w', newline='') if output else contextlib.nullcontext(sys.stdout)) as out:
+            (write_ndjson if fmt == 'ndjson' else write_csv)(capture, out, chunk_size)
+    finally:
+        capture.close()
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Export a --log_db capture without loading it into memory")
+    argp.add_argument('db', help="Capture DB, or the .manifest.json of a rotated capture")
+    argp.add_argument('-T', '--table', default='reads', choices=TABLES)
+    argp.add_argument('-f', '--format', default='ndjson', choices=FORMATS)
+    argp.add_argument('-o', '--output', default=None,
+                      help="Output file (a directory for npy); ndjson/csv default to stdout")
+    argp.add_argument('--path', default=None, help="Only rows for this path")
+    argp.add_argument('--partition', default=None, help="Only rows touching this partition (including ones spanning it and another)")
+    argp.add_argument('--call', default=None, help="Only this call (func_calls, extents)")
+    argp.add_argument('--offset_min', type=int, default=None, help="Only rows with offset >= this")
+    argp.add_argument('--offset_max', type=int, default=None, help="Only rows with offset < this")
+    argp.add_argument('--chunk_size', type=int, default=10000, help="Rows fetched per round trip")
+    args = argp.parse_args()
+    export(args.db, args.table, args.format, args.output,
+           {k: getattr(args, k) for k in ('path', 'partition', 'call', 'offset_min', 'offset_max')},
+           args.chunk_size)
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""Which file of which filesystem a byte of an image belongs to, for attributing logged reads.
+
+The FAT12/16/32 and ext2/3/4 filesystems in every GPT partition of an image (or in the whole
+image, without a GPT) are walked once, and every file's clusters/blocks go into one sorted extent
+table: parallel arrays of start and end byte offsets and a file number, searched with bisect.
+Filesystem metadata is attributed too ("[fat]", "[inode table]", "[journal]", ...); a file's ext
+extent tree and indirect blocks count as "[metadata]" rather than as the file's data.
+
+Indexing runs in a background thread at mount. Indexes are saved to --fs_index_dir under the hash
+of the image's contents, so an unchanged image is only hashed (or, if its size and mtime are the
+same as last time, not even that) on the next mount. The index describes the image as it was when
+the mount started; files the host creates later aren't in it.
+"""
+
+import argparse
+import array
+import hashlib
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from bisect import bisect_right
+
+import gpt
+import stats
+
+MAGIC = b'BADUSBFI'
+# Bumped whenever the parsers change what they produce, so old saved indexes are rebuilt
+VERSION = 2
+HEADER = struct.Struct('<8sIII')
+
+# FUSE path (e.g. /sd.img) -> FileIndex, once built or loaded
+INDEXES = {}
+# FUSE path -> how its index was obtained, for stats
+STATE = {}
+
+
+class FileIndex(object):
+    """Sorted, non-overlapping (start, end, file) byte extents of one image"""
+    def __init__(self, starts, ends, ids, names):
+        self.starts = starts
+        self.ends = ends
+        self.ids = ids
+        self.names = names
+
+    @classmethod
+    def from_extents(cls, extents, names):
+        """From unsorted (start, end, name id) tuples; touching extents of the same file are merged"""
+        starts, ends, ids = array.array('Q'), array.array('Q'), array.array('I')
+        for start, end, name in sorted(extents):
+            if end <= start:
+                continue
+            if ids and ids[-1] == name and ends[-1] == start:
+                ends[-1] = end
+                continue
+            starts.append(start)
+            ends.append(end)
+            ids.append(name)
+        return cls(starts, ends, ids, names)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def memory(self):
+        # 20 bytes of arrays per extent; a str per name
+        return {'entries': len(self.starts), 'bytes': len(self.starts) * 20 + sum(len(n) + 60 for n in self.names),
+                'cap': None}
+
+    def files(self, offset, length):
+        """Names of the files [offset, offset+length) touches, in disk order"""
+        starts, ends = self.starts, self.ends
+        end = offset + max(length, 1)
+        i = max(bisect_right(starts, offset) - 1, 0)
+        found = []
+        while i < len(starts) and starts[i] < end:
+            if ends[i] > offset:
+                name = self.names[self.ids[i]]
+                if name not in found:
+                    found.append(name)
+            i += 1
+        return found
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, len(self.starts), len(self.names)))
+            for arr in (self.starts, self.ends, self.ids):
+                if sys.byteorder != 'little':
+                    arr = array.array(arr.typecode, arr)
+                    arr.byteswap()
+                arr.tofile(fh)
+            fh.write('\0'.join(self.names).encode('utf8'))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as fh:
+            magic, version, count, num_names = HEADER.unpack(fh.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a version %i file index" % (path, VERSION))
+            arrays = []
+            for typecode in 'QQI':
+                arr = array.array(typecode)
+                arr.fromfile(fh, count)
+                if sys.byteorder != 'little':
+                    arr.byteswap()
+                arrays.append(arr)
+            names = fh.read().decode('utf8').split('\0') if num_names else []
+        return cls(arrays[0], arrays[1], arrays[2], names)
+
+
+class Extents(object):
+    """Collects (start, end, name) extents while a filesystem is walked"""
+    def __init__(self):
+        self.extents = []
+        self.names = []
+        self.ids = {}
+
+    def add(self, start, end, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        self.extents.append((start, end, i))
+
+    def runs(self, runs, unit, base, name):
+        """Add (first block, count) runs of blocks of size unit, merging consecutive ones"""
+        start = end = None
+        for first, count in runs:
+            if first == end:
+                end += count
+                continue
+            if start is not None:
+                self.add(base + start * unit, base + end * unit, name)
+            start, end = first, first + count
+        if start is not None:
+            self.add(base + start * unit, base + end * unit, name)
+
+    def index(self):
+        return FileIndex.from_extents(self.extents, self.names)
+
+
+def fat_extents(read, base, prefix, out):
+    """Index a FAT12/16/32 filesystem starting at byte base; False if there isn't one"""
+    boot = read(base, 512)
+    if len(boot) < 512 or boot[510:512] != b'\x55\xaa':
+        return False
+    bps, spc, reserved, num_fats, root_entries, total16, _, fat_size16 = struct.unpack_from('<HBHBHHBH', boot, 11)
+    total32, fat_size32 = struct.unpack_from('<II', boot, 32)
+    if bps not in (512, 1024, 2048, 4096) or not spc or spc & (spc - 1) or not num_fats or not reserved:
+        return False
+    fat_size = fat_size16 or fat_size32
+    total = total16 or total32
+    root_sectors = (root_entries * 32 + bps - 1) // bps
+    data_start = reserved + num_fats * fat_size + root_sectors
+    if not fat_size or total <= data_start:
+        return False
+    clusters = (total - data_start) // spc
+    bits = 12 if clusters < 4085 else 16 if clusters < 65525 else 32
+    fat = read(base + reserved * bps, fat_size * bps)
+    cluster_size = spc * bps
+    data_base = base + data_start * bps
+
+    def next_cluster(n):
+        if bits == 12:
+            v = struct.unpack_from('<H', fat, n + n // 2)[0]
+            return v >> 4 if n & 1 else v & 0xFFF
+        if bits == 16:
+            return struct.unpack_from('<H', fat, 2 * n)[0]
+        return struct.unpack_from('<I', fat, 4 * n)[0] & 0x0FFFFFFF
+
+    def chain(n):
+        """(cluster, 1) for every cluster of a chain, numbered from the start of the data area"""
+        found = []
+        while 2 <= n < clusters + 2 and len(found) <= clusters and (n * bits + 7) // 8 + 4 <= len(fat):
+            found.append((n - 2, 1))
+            n = next_cluster(n)
+        return found
+
+    def read_chain(blocks):
+        return b''.join(read(data_base + n * cluster_size, cluster_size) for n, _ in blocks)
+
+    out.add(base, base + reserved * bps, prefix + '[boot]')
+    out.add(base + reserved * bps, base + (reserved + num_fats * fat_size) * bps, prefix + '[fat]')
+    if bits == 32:
+        root_blocks = chain(struct.unpack_from('<I', boot, 44)[0])
+        out.runs(root_blocks, cluster_size, data_base, prefix + '/')
+        root = read_chain(root_blocks)
+    else:
+        root_start = base + (reserved + num_fats * fat_size) * bps
+        out.add(root_start, root_start + root_sectors * bps, prefix + '/')
+        root = read(root_start, root_sectors * bps)
+
+    seen = set()
+    dirs = [('/', root)]
+    while dirs:
+        path, data = dirs.pop()
+        long_name = []
+        for pos in range(0, len(data) - 31, 32):
+            entry = data[pos:pos + 32]
+            if entry[0] == 0:
+                break
+            attr = entry[11]
+            if entry[0] == 0xE5:
+                long_name = []
+                continue
+            if attr == 0x0F:
+                # Long name pieces come last-first, just ahead of their short entry
+                part = (entry[1:11] + entry[14:26] + entry[28:32]).decode('utf-16-le', 'replace')
+                long_name.insert(0, part.split('\0', 1)[0])
+                continue
+            if long_name:
+                name, long_name = ''.join(long_name), []
+            else:
+                base_name = entry[0:8].decode('latin1').rstrip()
+                ext = entry[8:11].decode('latin1').rstrip()
+                name = base_name + ('.' + ext if ext else '')
+            if attr & 0x08 or name in ('.', '..'):
+                continue
+            first = struct.unpack_from('<H', entry, 20)[0] << 16 | struct.unpack_from('<H', entry, 26)[0]
+            if first in seen:
+                continue
+            seen.add(first)
+            blocks = chain(first)
+            if attr & 0x10:
+                out.runs(blocks, cluster_size, data_base, prefix + path + name + '/')
+                dirs.append((path + name + '/', read_chain(blocks)))
+            else:
+                size = struct.unpack_from('<I', entry, 28)[0]
+                out.runs(blocks[:-(-size // cluster_size)], cluster_size, data_base, prefix + path + name)
+    return True
+
+
+def ext_extents(read, base, prefix, out):
+    """Index an ext2/3/4 filesystem starting at byte base; False if there isn't one"""
+    sb = read(base + 1024, 1024)
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 56)[0] != 0xEF53:
+        return False
+    inodes_count, blocks_lo = struct.unpack_from('<II', sb, 0)
+    first_data_block, log_block_size = struct.unpack_from('<II', sb, 20)
+    blocks_per_group, _, inodes_per_group = struct.unpack_from('<III', sb, 32)
+    rev_level = struct.unpack_from('<I', sb, 76)[0]
+    inode_size = struct.unpack_from('<H', sb, 88)[0] if rev_level else 128
+    compat, incompat = struct.unpack_from('<II', sb, 92)
+    is_64bit = incompat & 0x80
+    desc_size = max(struct.unpack_from('<H', sb, 254)[0], 64) if is_64bit else 32
+    blocks = blocks_lo | (struct.unpack_from('<I', sb, 336)[0] << 32 if is_64bit else 0)
+    bs = 1024 << log_block_size
+    if not blocks_per_group or not inodes_per_group or incompat & 0x10:
+        # No meta_bg support: its group descriptors are scattered across the disk
+        print("fsindex: unsupported ext layout at %i" % base)
+        return False
+    groups = -(-(blocks - first_data_block) // blocks_per_group)
+    gdt_start = (first_data_block + 1) * bs
+    gdt = read(base + gdt_start, groups * desc_size)
+    inode_tables = []
+    for g in range(groups):
+        lo = struct.unpack_from('<I', gdt, g * desc_size + 8)[0]
+        hi = struct.unpack_from('<I', gdt, g * desc_size + 0x28)[0] if desc_size >= 64 else 0
+        inode_tables.append(lo | hi << 32)
+    out.add(base + first_data_block * bs, base + gdt_start + groups * desc_size, prefix + '[superblock]')
+    for table in inode_tables:
+        out.add(base + table * bs, base + table * bs + inodes_per_group * inode_size, prefix + '[inode table]')
+
+    def inode(n):
+        g, i = divmod(n - 1, inodes_per_group)
+        return read(base + inode_tables[g] * bs + i * inode_size, 128)
+
+    def extent_tree(node, meta, depth_left=8):
+        magic, entries, _, depth = struct.unpack_from('<HHHH', node, 0)
+        if magic != 0xF30A or not depth_left:
+            return
+        for e in range(12, 12 + 12 * entries, 12):
+            if depth == 0:
+                _, length, start_hi, start_lo = struct.unpack_from('<IHHI', node, e)
+                # Lengths past 32768 mark uninitialized extents
+                yield start_hi << 32 | start_lo, length - 32768 if length > 32768 else length
+            else:
+                _, leaf_lo, leaf_hi = struct.unpack_from('<IIH', node, e)
+                leaf = leaf_hi << 32 | leaf_lo
+                meta.append((leaf, 1))
+                yield from extent_tree(read(base + leaf * bs, bs), meta, depth_left - 1)
+
+    def block_map(ptr, level, meta):
+        if not ptr or ptr >= blocks:
+            return
+        meta.append((ptr, 1))
+        for p in array_le(read(base + ptr * bs, bs)):
+            if level > 1:
+                yield from block_map(p, level - 1, meta)
+            elif p and p < blocks:
+                yield p, 1
+
+    def data_blocks(raw):
+        """(first block, count) runs holding an inode's data, and those of its extent/indirect blocks"""
+        flags = struct.unpack_from('<I', raw, 32)[0]
+        meta = []
+        if flags & 0x10000000:
+            return [], meta
+        i_block = raw[40:100]
+        if flags & 0x80000:
+            return list(extent_tree(i_block, meta)), meta
+        ptrs = struct.unpack('<15I', i_block)
+        found = [(p, 1) for p in ptrs[:12] if p and p < blocks]
+        for level, ptr in ((1, ptrs[12]), (2, ptrs[13]), (3, ptrs[14])):
+            found.extend(block_map(ptr, level, meta))
+        return found, meta
+
+    def add_inode(raw, name):
+        """Index an inode's data blocks under name; its extent/indirect blocks are filesystem metadata"""
+        found, meta = data_blocks(raw)
+        out.runs(found, bs, base, name)
+        out.runs(sorted(meta), bs, base, prefix + '[metadata]')
+        return found
+
+    if compat & 0x4:
+        add_inode(inode(8), prefix + '[journal]')
+
+    seen = set()
+    dirs = [(2, '/')]
+    while dirs and len(seen) < inodes_count:
+        ino, path = dirs.pop()
+        if ino in seen:
+            continue
+        seen.add(ino)
+        found = add_inode(inode(ino), prefix + path)
+        data = b''.join(read(base + b * bs, n * bs) for b, n in found)
+        pos = 0
+        while pos + 8 <= len(data):
+            child, rec_len, name_len, file_type = struct.unpack_from('<IHBB', data, pos)
+            if rec_len < 8:
+                break
+            if not incompat & 0x2:
+                name_len |= file_type << 8
+            name = data[pos + 8:pos + 8 + name_len].decode('utf8', 'replace')
+            pos += rec_len
+            if not child or child > inodes_count or name in ('.', '..') or child in seen:
+                continue
+            raw = inode(child)
+            mode = struct.unpack_from('<H', raw, 0)[0] & 0xF000
+            if mode == 0x4000:
+                dirs.append((child, path + name + '/'))
+            elif mode == 0x8000:
+                seen.add(child)
+                add_inode(raw, prefix + path + name)
+    return True
+
+
+def array_le(data):
+    arr = array.array('I', data[:len(data) - len(data) % 4])
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+PARSERS = (fat_extents, ext_extents)
+
+
+def volumes(fh, size):
+    """(name, first byte, end byte) of every GPT partition, or the whole image without a GPT"""
+    try:
+        header = gpt.read_header(fh)
+        gpt.verify_partitions(fh, header)
+        parts = [(p.name, p.first_lba * 512, (p.last_lba + 1) * 512) for p in gpt.read_partitions(fh, header)]
+    except (gpt.GPTError, struct.error) as e:
+        print("fsindex: no GPT (%s), indexing the image as one volume" % e)
+        return [('', 0, size)]
+    return parts
+
+
+def build(image):
+    """FileIndex of every filesystem found in an image"""
+    out = Extents()
+    size = os.path.getsize(image)
+    with open(image, 'rb') as fh:
+        fd = fh.fileno()
+
+        def read(offset, length):
+            return os.pread(fd, length, offset)
+
+        for name, start, end in volumes(fh, size):
+            prefix = name + ':' if name else ''
+            for parse in PARSERS:
+                try:
+                    if parse(read, start, prefix, out):
+                        break
+                except (struct.error, IndexError, ValueError) as e:
+                    print("fsindex: %s failed on %s: %s" % (parse.__name__, name or image, e))
+    return out.index()
+
+
+def image_hash(image, chunk=4 << 20):
+    h = hashlib.blake2b(digest_size=20)
+    with open(image, 'rb') as fh:
+        while True:
+            data = fh.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+def load_or_build(image, index_dir):
+    """(FileIndex, how it was obtained), reusing the index saved for the image's contents"""
+    st = os.stat(image)
+    known_path = os.path.join(index_dir, 'images.json')
+    known = {}
+    if os.path.exists(known_path):
+        with open(known_path) as fh:
+            known = json.load(fh)
+    entry = known.get(os.path.abspath(image))
+    if entry and entry[:2] == [st.st_size, st.st_mtime_ns]:
+        digest, how = entry[2], 'loaded'
+    else:
+        digest, how = image_hash(image), 'loaded (rehashed)'
+    index_path = os.path.join(index_dir, '%s.v%i.fsidx' % (digest, VERSION))
+    try:
+        index = FileIndex.load(index_path)
+    except (OSError, ValueError):
+        index, how = build(image), 'built'
+        index.save(index_path)
+    known[os.path.abspath(image)] = [st.st_size, st.st_mtime_ns, digest]
+    with open(known_path + '.tmp', 'w') as fh:
+        json.dump(known, fh, indent=2)
+    os.replace(known_path + '.tmp', known_path)
+    return index, how
+
+
+def index_images(images, index_dir):
+    for path, image in images:
+        STATE[path] = {'state': 'indexing'}
+        t0 = time.perf_counter()
+        try:
+            index, how = load_or_build(image, index_dir)
+        except OSError as e:
+            STATE[path] = {'state': 'failed: %s' % e}
+            continue
+        INDEXES[path] = index
+        STATE[path] = {'state': how, 'seconds': round(time.perf_counter() - t0, 3), 'extents': len(index),
+                       'files': len(index.names)}
+        print("fsindex: %s %s (%i extents, %i files)" % (how, path, len(index), len(index.names)))
+
+
+def init_fsindex(args):
+    """Index the images at the top of the root in the background"""
+    if not args.fs_index_dir:
+        return
+    os.makedirs(args.fs_index_dir, exist_ok=True)
+    images = sorted(('/' + e.name, e.path) for e in os.scandir(args.root) if e.is_file())
+    threading.Thread(target=index_images, args=(images, args.fs_index_dir), name="FSIndex", daemon=True).start()
+    stats.STATS.add_source('fsindex', lambda: dict(STATE))
+    stats.STATS.add_memory('fsindex', lambda: {path: index.memory() for path, index in list(INDEXES.items())})
+
+
+def get_files(path, offset, length):
+    """Comma separated files of the image at path a request touches ("N/A" until it's indexed)"""
+    index = INDEXES.get(path)
+    if index is None:
+        return "N/A"
+    return ','.join(index.files(offset, length)) or "N/A"
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Build an image's file index, or look up which files offsets are in")
+    argp.add_argument('image')
+    argp.add_argument('offsets', nargs='*', type=int, help="Byte offsets to look up")
+    argp.add_argument('--length', type=int, default=1, help="Length of each lookup")
+    argp.add_argument('--fs_index_dir', default=None, help="Load/save the index here (default: build in memory)")
+    argp.add_argument('--dump', action="store_true", help="Print every extent")
+    args = argp.parse_args()
+    t0 = time.perf_counter()
+    if args.fs_index_dir:
+        os.makedirs(args.fs_index_dir, exist_ok=True)
+        index, how = load_or_build(args.image, args.fs_index_dir)
+    else:
+        index, how = build(args.image), 'built'
+    print("%s %i extents, %i files in %.3fs" % (how, len(index), len(index.names), time.perf_counter() - t0))
+    if args.dump:
+        for start, end, i in zip(index.starts, index.ends, index.ids):
+            print("%12i %12i %s" % (start, end, index.names[i]))
+    for offset in args.offsets:
+        print("%i: %s" % (offset, ', '.join(index.files(offset, args.length)) or 'N/A'))
@@ -1,10 +1,17 @@
 """Simple GPT parsing"""
 
 import collections
+import functools
+import os
 import struct
+import threading
 import uuid
+import zlib
 from io import BytesIO
 
+import stats
+from intervals import IntervalIndex
+
 # http://en.wikipedia.org/wiki/GUID_Partition_Table#Partition_table_header_.28LBA_1.29
 GPT_HEADER_FORMAT = """
 8s signature
@@ -33,7 +40,8 @@ Q flags
 72s name
 """
 
-READS = []
+# LBAs the primary GPT occupies with the usual 128 x 128 byte entry array (MBR + header + 32)
+PRIMARY_GPT_LBAS = 34
 
 
 def _make_fmt(name, format, extras=[]):
@@ -44,13 +52,21 @@ def _make_fmt(name, format, extras=[]):
     return (fmt, tupletype)
 
 
-def get_partition(byte):
-    if not READS:
+def get_partition(byte, cache=None):
+    table = (cache or CACHE).current
+    if not table:
         return "N/A"
-    for part in READS[-1].values():
-        if part.first_byte <= byte < part.last_byte:
-            return part.name
-    return "N/A"
+    part = table.find(byte)
+    return part.name if part else "N/A"
+
+
+def get_partitions(offset, length, cache=None):
+    """Comma separated names of every partition the request [offset, offset+length) touches"""
+    table = (cache or CACHE).current
+    if not table:
+        return "N/A"
+    parts = table.spanning(offset, length)
+    return ','.join(p.name for p in parts) if parts else "N/A"
 
 class GPTError(Exception):
     pass
@@ -70,7 +86,12 @@ def read_header(fp, lba_size=512):
         raise GPTError('Bad revision: %r' % header.revision)
     if header.header_size < 92:
         raise GPTError('Bad header size: %r' % header.header_size)
-    # TODO check crc32
+    fp.seek(1*lba_size, 0)
+    raw = fp.read(header.header_size)
+    # The header CRC is computed with its own crc32 field zeroed
+    crc = zlib.crc32(raw[:16] + b'\0\0\0\0' + raw[20:])
+    if crc != header.crc32:
+        raise GPTError('Bad header crc32: %08x != %08x' % (crc, header.crc32))
     header = header._replace(
         disk_guid=str(uuid.UUID(bytes_le=header.disk_guid)),
         )
@@ -82,7 +103,8 @@ class Partition(object):
         self.name = name
         self.flags = flags
         self.first_byte = 512 * first_lba
-        self.last_byte = 512 * last_lba
+        # last_lba is inclusive; last_byte is the exclusive end
+        self.last_byte = 512 * (last_lba + 1)
         self.unique = unique
         self.type = type
 
@@ -92,12 +114,41 @@ class Partition(object):
                    unique=part.unique, type=part.type)
 
     def contains_byte(self, idx):
-        return (512 * self.first_byte) <= idx < (512 * self.last_byte)
+        return self.first_byte <= idx < self.last_byte
 
     def __repr__(self):
         return "Partition(%s):%iMB-%iMB:" % (self.name, self.first_byte >> 20, self.last_byte >> 20)
 
 
+class PartitionTable(dict):
+    """Partitions by name, plus an interval index over their byte ranges built once per parse"""
+    def __init__(self, parts=()):
+        super(PartitionTable, self).__init__((p.name, p) for p in parts)
+        self.index = IntervalIndex((p.first_byte, p.last_byte, p) for p in self.values())
+
+    def find(self, offset):
+        """The partition containing offset, or None"""
+        return self.index.find(offset)
+
+    def spanning(self, offset, length):
+        """Every partition overlapping [offset, offset+length), in disk order"""
+        return self.index.overlapping(offset, offset + max(length, 1))
+
+
+def entry_array_lbas(header, lba_size=512):
+    return -(-header.num_part_entries * header.part_entry_size // lba_size)
+
+
+def verify_partitions(fp, header, lba_size=512):
+    fp.seek(header.part_entry_start_lba * lba_size)
+    data = fp.read(header.num_part_entries * header.part_entry_size)
+    if len(data) < header.num_part_entries * header.part_entry_size:
+        raise GPTError('Short partition entry array: %i bytes' % len(data))
+    crc = zlib.crc32(data)
+    if crc != header.crc32_part_array:
+        raise GPTError('Bad partition array crc32: %08x != %08x' % (crc, header.crc32_part_array))
+
+
 def read_partitions(fp, header, lba_size=512):
     fp.seek(header.part_entry_start_lba * lba_size)
     fmt, GPTPartition = _make_fmt('GPTPartition', GPT_PARTITION_FORMAT, extras=['index'])
@@ -118,23 +169,145 @@ def read_partitions(fp, header, lba_size=512):
         yield part
 
 
-def parse(data, offset):
+class GPTCache(object):
+    """Parsed partition tables.
+
+    The GPT is parsed (and its CRCs verified) once, then reused for every later read of offset 0
+    until a write lands in the primary or backup GPT. Only the last `history` tables are kept.
+    """
+    def __init__(self, history=8, lba_size=512):
+        self.lba_size = lba_size
+        self.history = collections.deque(maxlen=history)
+        self.generation = 0         # number of tables parsed so far
+        self.probes = 0             # reads of offset 0 seen, parsed or not
+        self.valid = False
+        # The last parse failure, so a disk without a (good) GPT doesn't log it on every probe
+        self.error = None
+        self.regions = [(0, PRIMARY_GPT_LBAS * lba_size)]
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        history = self.history
+        return history[-1][1] if history else None
+
+    def get(self, generation):
+        """The table parsed as the given generation, if it's still in the history"""
+        for gen, table in self.history:
+            if gen == generation:
+                return table
+        return None
+
+    def resize(self, history):
+        with self.lock:
+            self.history = collections.deque(self.history, maxlen=history)
+
+    def parse(self, data, offset, fetch=None):
+        if offset != 0:
+            return
+        # Counted under the lock: with --threads, lost increments would skew the --num_reads switch
+        with self.lock:
+            self.probes += 1
+            if self.valid:
+                return
+            # Only a successful parse is kept; after a failure the next probe (maybe a longer read,
+            # or after the host wrote a GPT) tries again
+            try:
+                table, regions = self._parse(data, fetch)
+            except (GPTError, struct.error) as e:
+                if str(e) != self.error:
+                    print("GPT parse failed: %s" % e)
+                self.error = str(e)
+                return
+            self.valid = True
+            self.error = None
+            self.regions = regions
+            self.generation += 1
+            self.history.append((self.generation, table))
+        print("Parsed GPT:\n  " + '\n  '.join([("%s: %s" % (k, repr(v))) for k, v in table.items()]))
+
+    def _parse(self, data, fetch):
+        lba = self.lba_size
+        if len(data) < 2 * lba and fetch:
+            # The host only read the MBR (or part of it); fetch the header too
+            data = fetch(2 * lba, 0)
+        fp = BytesIO(data)
+        header = read_header(fp, lba)
+        array_end = (header.part_entry_start_lba + entry_array_lbas(header, lba)) * lba
+        if len(data) < array_end and fetch:
+            # The host only read the start of the disk; fetch the rest of the entry array
+            fp = BytesIO(fetch(array_end, 0))
+        verify_partitions(fp, header, lba)
+        table = PartitionTable(Partition.from_gpt(i) for i in read_partitions(fp, header, lba))
+        # Writes to either copy of the GPT invalidate the cached table
+        backup_start = (header.backup_lba - entry_array_lbas(header, lba)) * lba
+        regions = [(0, max(array_end, PRIMARY_GPT_LBAS * lba)), (backup_start, (header.backup_lba + 1) * lba)]
+        return table, regions
+
+    def written(self, offset, length):
+        """Invalidate the cached table if [offset, offset+length) overlaps either copy of the GPT"""
+        end = offset + length
+        for start, stop in self.regions:
+            if offset < stop and start < end:
+                self.valid = False
+                return
+
+    def stats(self):
+        return {'generation': self.generation, 'probes': self.probes, 'valid': self.valid, 'error': self.error,
+                'history': len(self.history)}
+
+    def memory(self):
+        # A Partition plus its interval index entries, per partition of every remembered table
+        partitions = sum(len(table) for _, table in list(self.history))
+        return {'entries': len(self.history), 'bytes': partitions * 1000, 'cap': self.history.maxlen}
+
+
+CACHE = GPTCache()
+stats.STATS.add_source('gpt', CACHE.stats)
+stats.STATS.add_memory('gpt', CACHE.memory)
+
+
+def init_gpt(args):
+    CACHE.resize(args.gpt_history)
+
+
+def parse(data, offset, fetch=None, cache=None):
     if offset < (1 << 16):
         print("GPT parser received %i bytes at offset %i" % (len(data), offset))
-    if offset != 0:
-        return
-    fp = BytesIO(data)
-    header = read_header(fp)
-    parts = [i for i in read_partitions(fp, header)]
-    READS.append({i.name: Partition.from_gpt(i) for i in parts})
-    print("Parsed GPT:\n  " + '\n  '.join([("%s: %s" % (k, repr(v))) for k, v in READS[-1].items()]))
+    (cache or CACHE).parse(data, offset, fetch)
+
+
+def cache_for(fs, path):
+    """The GPTCache of the image a Passthrough serves at path (gpt.CACHE for anything else)"""
+    image = getattr(fs, 'image', None)
+    return image(path).gpt if image else CACHE
 
 
 def parse_gpt(func):
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         _kwargs = dict(zip(func.__code__.co_varnames, args))
         _kwargs.update(kwargs)
         data = func(*args, **kwargs)
-        parse(data, _kwargs['offset'])
+        t0 = stats.now()
+        fh = _kwargs.get('fh')
+        # Fetch the rest of the entry array the way the filesystem reads (e.g. through an overlay)
+        fs = _kwargs.get('self')
+        pread = getattr(fs, '_pread', os.pread)
+        parse(data, _kwargs['offset'], (lambda n, o: pread(fh, n, o)) if fh is not None else None,
+              cache_for(fs, _kwargs.get('path')))
+        stats.record('gpt_parse', stats.now() - t0)
         return data
     return wrapper
+
+
+def watch_gpt(func):
+    """Invalidate the cached GPT when a write touches it"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _kwargs = dict(zip(func.__code__.co_varnames, args))
+        _kwargs.update(kwargs)
+        res = func(*args, **kwargs)
+        cache_for(_kwargs.get('self'), _kwargs.get('path')).written(_kwargs['offset'], len(_kwargs['buf']))
+        return res
+    return wrapper
@@ -0,0 +1,105 @@
+"""Per-image state, so one mount can serve several images, each with its own GPT, injection rules
+and loggers.
+
+Images are listed in the config's "images" section:
+
+    "images": [{"path": "/sd.img", "modifiers": [...]}]
+
+Each gets its own GPTCache, an Injector over its modifiers (their "path" defaults to the image's)
+and a LogSet writing to per-image log files (capture.db -> capture.sd.img.db). Paths that aren't
+listed share the default image: gpt.CACHE, injector.INJECTOR, logger.LOGS and the top-level
+"modifiers", as before.
+
+The modifiers (top-level and per image) can be changed without a remount: edit the config and
+send SIGHUP or the 'reload' control command. Images added to or removed from the config still
+need a remount.
+"""
+
+import json
+import signal
+import threading
+
+import control
+import gpt
+import injector
+import logger
+import stats
+
+# The config the images were loaded from, and the images, for reloads
+CONFIG = None
+IMAGES = {}
+
+
+class Image(object):
+    def __init__(self, path, gpt_cache, injector, logs):
+        self.path = path
+        self.gpt = gpt_cache
+        self.injector = injector
+        self.logs = logs
+
+
+def default_image():
+    return Image(None, gpt.CACHE, injector.INJECTOR, logger.LOGS)
+
+
+def shard_name(path):
+    return path.strip('/').replace('/', '_')
+
+
+def image_modifiers(conf):
+    return [dict(modifier, path=modifier.get('path', conf['path'])) for modifier in conf.get('modifiers', [])]
+
+
+def load_images(args):
+    """path -> Image for every image in the config's images section"""
+    global CONFIG, IMAGES
+    with open(args.config) as fh:
+        config = json.load(fh)
+    images = {}
+    for conf in config.get('images', []):
+        path = conf['path']
+        name = shard_name(path)
+        cache = gpt.GPTCache(args.gpt_history)
+        stats.STATS.add_source('gpt.' + name, cache.stats)
+        stats.STATS.add_memory('gpt.' + name, cache.memory)
+        logs = logger.LogSet(cache, name)
+        logs.init(args)
+        logger.LOGSETS.append(logs)
+        images[path] = Image(path, cache, injector.Injector(image_modifiers(conf), cache), logs)
+        stats.STATS.add_source('injector.' + name, images[path].injector.stats)
+    CONFIG, IMAGES = args.config, images
+    return images
+
+
+@control.command('reload')
+def reload_rules():
+    """Re-read the config's modifiers into the default and per-image injectors"""
+    with open(CONFIG) as fh:
+        config = json.load(fh)
+    result = {'default': injector.INJECTOR.reload(config.get('modifiers', []))}
+    for conf in config.get('images', []):
+        image = IMAGES.get(conf['path'])
+        if image is None:
+            result[conf['path']] = 'not loaded; remount to add images'
+            continue
+        result[conf['path']] = image.injector.reload(image_modifiers(conf))
+    return result
+
+
+def reload_on_sighup():
+    """Reload on SIGHUP. Must run before any other thread starts.
+
+    FUSE's threads never run Python signal handlers (and its main thread only does between
+    requests), so SIGHUP is blocked everywhere and a dedicated thread waits for it instead.
+    """
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGHUP})
+
+    def wait():
+        while True:
+            signal.sigwait({signal.SIGHUP})
+            try:
+                print("Reloaded injection rules: %s" % json.dumps(reload_rules()))
+            except Exception as e:
+                print("Reloading injection rules failed, keeping the old ones: %s: %s" % (type(e).__name__, e))
+
+    threading.Thread(target=wait, name="SIGHUP", daemon=True).start()
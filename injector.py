@@ -1,18 +1,122 @@
+import collections
 import json
+import os
+import threading
+import cache
 import gpt
+import overlay
+import stats
+
+from intervals import IntervalIndex
 
 INJECTOR = None
 
 
+class StrSource(object):
+    """Replacement bytes given inline in the config"""
+    def __init__(self, value):
+        self.value = value.encode('utf8') if isinstance(value, str) else value
+
+    def read(self, offset, length):
+        return self.value
+
+
+class FileSource(object):
+    """Replacement bytes from a file opened on first use and then held open until its rule is dropped.
+
+    Reads in progress are counted, so closing (after a reload retires the rule) waits for the last
+    one: a read must never pread a closed fd, or one reused for another file.
+    """
+    def __init__(self, filename, start=None, length=None):
+        self.filename = filename
+        self.start = start
+        self.length = length
+        self.fd = None
+        self.name = os.path.abspath(filename)
+        self.lock = threading.Lock()
+        self.readers = 0
+        self.closed = False
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.fd is None:
+                self.fd = os.open(self.filename, os.O_RDONLY)
+            fd = self.fd
+            self.readers += 1
+        try:
+            start = offset if self.start is None else self.start
+            return cache.cached_read(self.name, os.pread, fd, length if self.length is None else self.length, start)
+        finally:
+            with self.lock:
+                self.readers -= 1
+                if self.closed and not self.readers:
+                    self._close()
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        """Close the file now, or once the reads still using it are done"""
+        with self.lock:
+            self.closed = True
+            if not self.readers:
+                self._close()
+
+
+class OverlaySource(FileSource):
+    """Replacement bytes from a file as the host has written it (through its overlay, with --overlay_dir)"""
+    def read(self, offset, length):
+        cow = overlay.get_overlay(self.filename)
+        if cow is None:
+            return super(OverlaySource, self).read(offset, length)
+        return cow.read(offset, length)
+
+
+class EmptySource(object):
+    def read(self, offset, length):
+        return b""
+
+
+def make_source(replace):
+    if replace['source'] == 'str':
+        return StrSource(replace['value'])
+    elif replace['source'] in ('file', 'partition'):
+        return FileSource(replace['filename'], replace.get('start'), replace.get('length'))
+    elif replace['source'] == 'cow':
+        return OverlaySource(replace['filename'])
+    else:
+        return EmptySource()
+
+
 class BaseInject(object):
-    def __init__(self, replace, trigger):
+    def __init__(self, replace, trigger, gpt_cache=None):
+        # The image's GPTCache (gpt.CACHE unless the image has its own)
+        self.gpt_cache = gpt_cache or gpt.CACHE
         self.replace = replace
         self.trigger = trigger
+        # Trigger counters live on the inject rather than in the config dict; with --threads
+        # concurrent reads of the trigger range must not lose increments
+        self.count = self.trigger.get('count', 0)
+        self.count_lock = threading.Lock()
+        self.source = make_source(replace)
         self.init_trigger()
 
     def init_trigger(self):
         pass
 
+    def bind_current(self):
+        """Added to a running mount: work from the GPT parsed so far (for injects that use one)"""
+        pass
+
+    def bump(self):
+        """Atomically increment the trigger counter, returning the value before the increment"""
+        with self.count_lock:
+            count = self.count
+            self.count = count + 1
+        return count
+
     @property
     def triggered(self):
         return True
@@ -21,81 +125,80 @@ class BaseInject(object):
     def byte(self):
         return -1
 
+    def span(self):
+        """The [start, end) byte range this inject can touch, or None if not (yet) known"""
+        if self.byte < 0:
+            return None
+        return self.byte, self.byte + 1
+
     def right_byte(self, offset, length):
         return offset <= self.byte < offset + length
 
     def read(self, offset, length):
-        if self.replace['source'] == 'str':
-            return self.replace['value']
-        elif self.replace['source'] == 'file':
-            with open(self.replace['filename']) as fh:
-                fh.seek(self.replace.get('start', offset), 0)
-                return fh.read(self.replace.get('length', length))
-        elif self.replace('source') == 'cow':
-            with open(self.replace['filename']) as fh:
-                fh.seek(offset)
-                return fh.read(length)
-        else:
-            return ""
+        return self.source.read(offset, length)
 
-    def modify(self, offset, length, data):
-        """Modify the data however we're supposed to"""
-        pre = data[:self.byte - offset]                         # if we want to replace
-        injecting = self.read(offset, length)[:length - len(pre)]
-        post = data[len(pre) + len(injecting):length]
-        modified = "%s%s%s" % (pre, injecting, post)
-        return modified
+    def apply(self, offset, buf):
+        """Write our replacement into buf (the request's data, starting at offset) in place"""
+        pos = self.byte - offset                                # if we want to replace
+        injecting = self.read(offset, len(buf))[:len(buf) - pos]
+        buf[pos:pos + len(injecting)] = injecting
 
 
 class PartitionReplaceInject(BaseInject):
-    def __init__(self, *args, **kwargs):
-        self.initial_num_gpts = len(gpt.READS)
+    def __init__(self, replace, trigger, gpt_cache=None):
+        self.initial_generation = (gpt_cache or gpt.CACHE).generation
+        self.table = None
         self.part = None
-        super(PartitionReplaceInject, self).__init__(*args, **kwargs)
+        super(PartitionReplaceInject, self).__init__(replace, trigger, gpt_cache)
+
+    def bind_current(self):
+        # The cache won't parse again until the host writes to the GPT, so "the next one" may never come
+        self.table = self.gpt_cache.current
 
     @property
     def gpt(self):
-        if len(gpt.READS) == self.initial_num_gpts:
+        """The first GPT parsed after this inject was created (or the current one, see bind_current)"""
+        cache = self.gpt_cache
+        if self.table is None and cache.generation > self.initial_generation:
+            self.table = cache.get(self.initial_generation + 1) or cache.current
+        return self.table
+
+    def span(self):
+        table = self.gpt
+        self.part = table.get(self.trigger['partition']) if table else None
+        if not self.part:
             return None
-        else:
-            return gpt.READS[self.initial_num_gpts]
+        return self.part.first_byte, self.part.last_byte
 
     def right_byte(self, offset, length):
-        if self.gpt:
-            self.part = self.gpt.get(self.trigger('partition'))
-
-        if self.part and self.part.first_byte <= offset < self.part.last_byte:
+        part = self.part
+        if part and part.first_byte <= offset < part.last_byte:
             # Increment the counter if we're reading the first byte of the partition
-            if offset <= self.part.first_byte < offset + length:
-                self.trigger['count'] += 1
+            if offset <= part.first_byte < offset + length:
+                self.bump()
             return True
         else:
             return False
 
     @property
     def triggered(self):
-        return self.trigger['count'] > self.trigger['value']
+        return self.count > self.trigger.get('value', 0)
 
-    def modify(self, offset, length, data):
-        self.replace['start'] = offset - self.part.first_byte
-        with open(self.replace['filename'], 'r') as fh:
-            fh.seek(offset - self.part.first_byte)
-            modified = fh.read(length)
-        if len(modified) < length:
-            modified += data[len(modified):]
-        return modified
+    def apply(self, offset, buf):
+        # Anything past the end of the replacement file keeps the original data; a source with a
+        # configured length can return more than asked for, which mustn't grow the read
+        replacement = self.source.read(offset - self.part.first_byte, len(buf))[:len(buf)]
+        buf[:len(replacement)] = replacement
 
 
 class ByteTriggerInject(BaseInject):
     def init_trigger(self):
         if self.trigger['type'] == 'read_count':
-            self.trigger['count'] = 0
+            self.count = 0
 
     @property
     def triggered(self):
-        read_count = self.trigger['count']
-        self.trigger['count'] += 1
-        return read_count >= self.trigger['value']
+        return self.bump() >= self.trigger['value']
 
     @property
     def byte(self):
@@ -108,35 +211,134 @@ INJECT_TYPES = {
     }
 
 
+def rule_identity(path, replace, trigger):
+    """Rules with the same identity are the same rule across reloads"""
+    return json.dumps([path, replace, trigger], sort_keys=True)
+
+
+def make_inject(path, replace, trigger, gpt_cache=None, bind_current=False):
+    inject_type = INJECT_TYPES.get(trigger['type'])
+    if inject_type is None:
+        raise ValueError("Unknown trigger type %r for %s" % (trigger['type'], path))
+    inject = inject_type(replace, trigger, gpt_cache)
+    if bind_current:
+        inject.bind_current()
+    inject.identity = rule_identity(path, replace, trigger)
+    return inject
+
+
+class PathTable(object):
+    """Injects for one path compiled into an interval index over the byte ranges they touch"""
+    def __init__(self, injects, gpt_cache):
+        self.injects = injects
+        self.gpt_cache = gpt_cache
+        # Partition injects only get a range once a GPT is parsed, so recompile when that changes
+        self.generation = gpt_cache.generation
+        self.index = IntervalIndex((span[0], span[1], i) for i, span in ((i, i.span()) for i in injects) if span)
+
+    @property
+    def stale(self):
+        return self.generation != self.gpt_cache.generation
+
+
+class RuleSet(object):
+    """A compiled set of injects (path -> [inject]), never changed once built; reloads swap in a new one.
+
+    The only later change is a path's table being recompiled for a new GPT, which replaces the
+    table object whole.
+    """
+    def __init__(self, injects, gpt_cache):
+        self.injects = injects
+        self.tables = dict((path, PathTable(path_injects, gpt_cache)) for path, path_injects in injects.items())
+
+    def __len__(self):
+        return sum(len(path_injects) for path_injects in self.injects.values())
+
+
 class Injector(object):
     """Handles injecting data"""
-    def __init__(self, injections):
-        self.injects = {}
-        for inject in injections:
-            self.add_inject(**inject)
+    def __init__(self, injections, gpt_cache=None):
+        self.gpt_cache = gpt_cache or gpt.CACHE
+        self.rules = RuleSet({}, self.gpt_cache)
+        self.reloads = 0
+        self.reload_lock = threading.Lock()
+        self.reload(injections, bind_current=False)
+        self.reloads = 0
+
+    @property
+    def injects(self):
+        return self.rules.injects
 
     def add_inject(self, path, replace, trigger):
         """Add an injection config"""
-        if path not in self.injects:
-            self.injects[path] = []
-        inject_type = INJECT_TYPES.get(trigger['type'])
-        self.injects[path].append(inject_type(replace, trigger))
+        with self.reload_lock:
+            injects = dict(self.rules.injects)
+            injects[path] = injects.get(path, []) + [make_inject(path, replace, trigger, self.gpt_cache, True)]
+            self.rules = RuleSet(injects, self.gpt_cache)
+
+    def reload(self, injections, bind_current=True):
+        """Swap in a new set of injection configs.
+
+        A rule that was already loaded (same path, replace and trigger) keeps its inject, and with
+        it its trigger counter, the GPT it bound to and its open replacement file. New partition
+        rules bind to the GPT already parsed, if any (bind_current). The new set is built completely
+        before it replaces the old one, and a bad config leaves the old one in place.
+        """
+        with self.reload_lock:
+            current = collections.defaultdict(collections.deque)
+            for path_injects in self.rules.injects.values():
+                for inject in path_injects:
+                    current[inject.identity].append(inject)
+            injects = {}
+            kept = 0
+            for conf in injections:
+                path, replace, trigger = conf['path'], conf['replace'], conf['trigger']
+                same = current.get(rule_identity(path, replace, trigger))
+                if same:
+                    inject = same.popleft()
+                    kept += 1
+                else:
+                    inject = make_inject(path, replace, trigger, self.gpt_cache, bind_current)
+                injects.setdefault(path, []).append(inject)
+            rules = RuleSet(injects, self.gpt_cache)
+
+            # Reads that started before the swap finish with the old set; sources close after their last read
+            self.rules = rules
+            retired = [inject for same in current.values() for inject in same]
+            for inject in retired:
+                close = getattr(inject.source, 'close', None)
+                if close:
+                    close()
+            self.reloads += 1
+        return {'rules': len(rules), 'kept': kept, 'added': len(rules) - kept, 'removed': len(retired)}
+
+    def stats(self):
+        return {'rules': len(self.rules), 'reloads': self.reloads,
+                'counts': [inject.count for path_injects in self.rules.injects.values() for inject in path_injects]}
 
     def get_injects(self, path, length, offset):
-        same_path = self.injects.get(path, [])
-        if not same_path:
-            return same_path
-        same_byte = [i for i in same_path if i.right_byte(offset, length)]
+        rules = self.rules
+        table = rules.tables.get(path)
+        if table is None:
+            return []
+        if table.stale:
+            table = rules.tables[path] = PathTable(table.injects, self.gpt_cache)
+        same_byte = table.index.overlapping(offset, offset + length)
         if not same_byte:
             return same_byte
+        same_byte = [i for i in same_byte if i.right_byte(offset, length)]
         return [i for i in same_byte if i.triggered]
 
     def handle(self, path, length, offset, data):
         injects = self.get_injects(path, length, offset)
+        if not injects:
+            return data
+        # One mutable copy of the request that every inject writes into
+        buf = bytearray(data)
         for inject in injects:
-            data = inject.modify(offset, length, data)
+            inject.apply(offset, buf)
             print("Modifying data using injector %s" % repr(inject))
-        return data
+        return bytes(buf)
 
 
 def init_injector(args):
@@ -144,6 +346,7 @@ def init_injector(args):
     with open(args.config) as fh:
         config = json.load(fh)
     INJECTOR = Injector(config.get('modifiers', []))
+    stats.STATS.add_source('injector', INJECTOR.stats)
 
 
 def inject(path, length, offset, data):
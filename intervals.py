@@ -0,0 +1,43 @@
+"""Sorted interval lookups over half-open [start, end) byte ranges"""
+
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex(object):
+    """Immutable index of (start, end, value) intervals, built once and queried with bisect.
+
+    Intervals may overlap. Lookups are O(log n + k) for k matches: candidates are the intervals
+    starting before the end of the query, pruned by a running maximum of interval ends.
+    """
+    def __init__(self, intervals=()):
+        intervals = sorted((i for i in intervals if i[0] < i[1]), key=lambda i: (i[0], i[1]))
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+        self.values = [i[2] for i in intervals]
+        self.max_ends = []
+        max_end = None
+        for end in self.ends:
+            max_end = end if max_end is None else max(max_end, end)
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def overlapping(self, start, end):
+        """Values of every interval overlapping [start, end), in start order"""
+        hi = bisect_left(self.starts, end)
+        lo = bisect_right(self.max_ends, start, 0, hi)
+        ends = self.ends
+        return [self.values[i] for i in range(lo, hi) if ends[i] > start]
+
+    def find(self, point):
+        """Value of the first interval containing point, or None"""
+        hi = bisect_right(self.starts, point)
+        lo = bisect_right(self.max_ends, point, 0, hi)
+        for i in range(lo, hi):
+            if self.ends[i] > point:
+                return self.values[i]
+        return None
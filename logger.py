@@ -1,33 +1,251 @@
+import collections
+import functools
+import hashlib
+import inspect
 import json
+import lzma
+import operator
 import os
+import pickle
+import queue
 import sqlite3
+import threading
 import time
 import types
+import zlib
+import control
+import fsindex
 import gpt
+import stats
+import tracefile
 
-from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
 
-LOGGERS = []
+# One Route per @logs-decorated function; each LogSet works out which of its loggers each one feeds
+ROUTES = []
+# The call name coalesced extents are logged under
+EXTENT_CALL = 'extent'
+# Entries of a listing result (e.g. readdir) kept in its log record
+MAX_LOGGED_ENTRIES = 1000
+# What the async DB writer does with a call once its queue is full
+QUEUE_POLICIES = ('drop', 'block', 'spill')
+
+
+# Digests are at most 32 bytes so they fit a trace record
+HASHES = {
+    'sha256': hashlib.sha256,
+    'sha1': hashlib.sha1,
+    'md5': hashlib.md5,
+    'blake2b': lambda data=b'': hashlib.blake2b(data, digest_size=32),
+    'blake2s': hashlib.blake2s,
+}
+
+COMPRESSORS = {
+    'zlib': zlib.compress,
+    'lzma': lzma.compress,
+}
 
 
 class Blob:
     """Automatically encode a binary string."""
-    def __init__(self, s, log_bytes, log_hash):
+    def __init__(self, s, log_bytes, log_hash, algorithm='sha256', compression=None):
         self.s = s
         self.log_bytes = log_bytes
         self.log_hash = log_hash
+        self.algorithm = algorithm
+        self.compression = compression
 
     @property
     def blob(self):
-        return sqlite3.Binary(self.s if self.log_bytes else b'')
+        if not self.log_bytes:
+            return sqlite3.Binary(b'')
+        if self.compression:
+            return sqlite3.Binary(COMPRESSORS[self.compression](self.s))
+        return sqlite3.Binary(self.s)
 
     @property
     def length(self):
         return len(self.s)
 
     @property
-    def sha256(self):
-        return sha256(self.s).hexdigest() if (self.s and self.log_hash) else b''
+    def digest(self):
+        # Stored bytes are content-addressed by their hash, so log_bytes implies hashing
+        return HASHES[self.algorithm](self.s).hexdigest() if (self.s and (self.log_hash or self.log_bytes)) else b''
+
+
+def digest(buf, log_bytes, log_hash, algorithm='sha256', compression=None):
+    """Hash (and compress) a buffer into the '_buffer*' fields the DB queries use.
+
+    Runs inline or on DBLogger's worker pool; hashlib, zlib and lzma release the GIL on large
+    buffers, so pool threads run in parallel with the FUSE thread.
+    """
+    blob = Blob(buf, log_bytes, log_hash, algorithm, compression)
+    return {'_buffer': blob.blob, '_buffer_length': blob.length, '_buffer_hash': blob.digest,
+            '_compression': compression if log_bytes else None}
+
+
+def digests(bufs, *args):
+    return [digest(buf, *args) for buf in bufs]
+
+
+class DeferredInserts(object):
+    """A logged call whose buffers are still being hashed on the pool; the DB writer resolves it"""
+    def __init__(self, logger, inserts, future, infos, data_queries, bufs):
+        self.logger = logger
+        self.inserts = inserts
+        self.future = future
+        self.infos = infos
+        self.data_queries = data_queries
+        # Bytes held for the buffers being hashed (a write's buf, a read's result) and the call's inserts
+        self.size = sum(len(buf) for buf in bufs) + record_size(inserts)
+
+    def __call__(self):
+        inserts = self.inserts
+        for info, fields in zip(self.infos, self.future.result()):
+            info.update(fields)
+            inserts.extend(self.logger.blob_inserts(info))
+            inserts.extend((sql, extract(info)) for sql, extract in self.data_queries)
+        return inserts
+
+
+class WriteIndex(object):
+    """Digest of every block as it was last written, per path, to split writes into changed runs.
+
+    Only blocks a write covers entirely can be compared; partly covered ones are always logged
+    (and forgotten). Before the first write to a block, Passthrough.write seeds its digest from the
+    image's previous content (see LogSet.seed_writes), so rewriting a block with what's already
+    there isn't logged either.
+    """
+    # dict slot, int key and 16 byte digest object
+    ENTRY_BYTES = 120
+
+    def __init__(self, block_size=4096, max_blocks=0):
+        self.block_size = block_size
+        # path -> {block number: digest}; forgotten entirely past max_blocks (later writes are then logged whole)
+        self.blocks = {}
+        self.size = 0
+        self.max_blocks = max_blocks
+        self.resets = 0
+        self.lock = threading.Lock()
+        # (path, block offset) -> identical rewrites since the last flush
+        self.rewrites = collections.Counter()
+        self.changed = 0
+        self.unchanged = 0
+        self.seeded = 0
+
+    def unseen(self, path, offset, length):
+        """[(start, end)] byte runs of the blocks [offset, offset+length) covers entirely that have no digest"""
+        bs = self.block_size
+        runs = []
+        with self.lock:
+            blocks = self.blocks.get(path, {})
+            for n in range(-(-offset // bs), (offset + length) // bs):
+                if n in blocks:
+                    continue
+                if runs and runs[-1][1] == n * bs:
+                    runs[-1][1] += bs
+                else:
+                    runs.append([n * bs, (n + 1) * bs])
+        return runs
+
+    def seed(self, path, offset, data):
+        """Digest the whole blocks of data (read from block aligned offset) that have none yet"""
+        bs = self.block_size
+        view = memoryview(data)
+        hashes = [hashlib.blake2b(view[i:i + bs], digest_size=16).digest() for i in range(0, len(data) - bs + 1, bs)]
+        with self.lock:
+            if self.max_blocks and self.size + len(hashes) > self.max_blocks:
+                # Left to diff, which resets the index
+                return
+            blocks = self.blocks.setdefault(path, {})
+            for n, h in enumerate(hashes, offset // bs):
+                if n not in blocks:
+                    blocks[n] = h
+                    self.size += 1
+                    self.seeded += 1
+
+    def diff(self, path, buf, offset):
+        """[(offset, bytes)] for the runs of buf that differ from what was last written there"""
+        bs = self.block_size
+        end = offset + len(buf)
+        first, last = -(-offset // bs), end // bs
+        view = memoryview(buf)
+        hashes = [hashlib.blake2b(view[n * bs - offset:(n + 1) * bs - offset], digest_size=16).digest()
+                  for n in range(first, last)]
+        # [start, stop) of the changed runs, relative to buf
+        runs = []
+        head = min(first * bs, end) - offset
+        if head > 0:
+            runs.append([0, head])
+        with self.lock:
+            if self.max_blocks and self.size + len(hashes) > self.max_blocks:
+                self.blocks.clear()
+                self.size = 0
+                self.resets += 1
+            blocks = self.blocks.setdefault(path, {})
+            if offset % bs and blocks.pop(offset // bs, None) is not None:
+                self.size -= 1
+            if end % bs and blocks.pop(end // bs, None) is not None:
+                self.size -= 1
+            for n, h in zip(range(first, last), hashes):
+                old = blocks.get(n)
+                if old == h:
+                    self.unchanged += 1
+                    self.rewrites[(path, n * bs)] += 1
+                    continue
+                if old is None:
+                    self.size += 1
+                blocks[n] = h
+                self.changed += 1
+                start = n * bs - offset
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = start + bs
+                else:
+                    runs.append([start, start + bs])
+        tail = max(last * bs, offset) - offset
+        if last >= first and tail < len(buf):
+            if runs and runs[-1][1] == tail:
+                runs[-1][1] = len(buf)
+            else:
+                runs.append([tail, len(buf)])
+        if runs == [[0, len(buf)]]:
+            return [(offset, buf)]
+        return [(offset + start, bytes(view[start:stop])) for start, stop in runs]
+
+    def forget(self, path, offset=0):
+        """Drop the digests of path's blocks from the one holding offset on (after a truncate or unlink)"""
+        first = offset // self.block_size
+        with self.lock:
+            blocks = self.blocks.get(path)
+            if not blocks:
+                return
+            gone = [n for n in blocks if n >= first]
+            for n in gone:
+                del blocks[n]
+            self.size -= len(gone)
+            if not blocks:
+                del self.blocks[path]
+
+    def rename(self, old, new):
+        """Move the digests of old, or of every path under it, to the new name"""
+        with self.lock:
+            for path in [p for p in self.blocks if p == old or p.startswith(old.rstrip('/') + '/')]:
+                target = new + path[len(old):]
+                self.size -= len(self.blocks.pop(target, ()))
+                self.blocks[target] = self.blocks.pop(path)
+
+    def take_rewrites(self):
+        with self.lock:
+            rewrites, self.rewrites = self.rewrites, collections.Counter()
+        return rewrites
+
+    def stats(self):
+        return {'block_size': self.block_size, 'indexed_blocks': self.size,
+                'changed_blocks': self.changed, 'unchanged_blocks': self.unchanged, 'seeded_blocks': self.seeded,
+                'resets': self.resets}
+
+    def memory(self):
+        return stats.usage(self.size, self.ENTRY_BYTES, self.max_blocks or None)
 
 
 class FileLogger(object):
@@ -41,61 +259,567 @@ class FileLogger(object):
         if not os.path.exists(os.path.dirname(self.log_file)):
             os.makedirs(os.path.dirname(self.log_file))
 
-        fhandle = open(self.log_file, 'a' if os.path.exists(self.log_file) else 'w')
-        fhandle.write(self.FILE_PREAMBLE)
-        self._write = fhandle.write
+        self.fhandle = open(self.log_file, 'a' if os.path.exists(self.log_file) else 'w')
+        self.fhandle.write(self.FILE_PREAMBLE)
+        self._write = self.fhandle.write
+        self.lock = threading.Lock()
 
     def add_call(self, call):
         self.logged_calls.add(call)
 
+    def wants(self, call):
+        return call in self.logged_calls or self.log_all
+
     def format(self, info):
         kwargs = {k: str(v)[:500] for k, v in info.items() if k[0] != '_'}
         return "%s: state: %s:   %s\n" % (info['_call'], info['_state'], json.dumps(kwargs))
 
     def log(self, info):
-        if info['_call'] in self.logged_calls or self.log_all:
-            self._write(self.format(info))
+        t0 = stats.now()
+        line = self.format(info)
+        t1 = stats.now()
+        with self.lock:
+            self._write(line)
+        stats.record('log_format', t1 - t0)
+        stats.record('log_write', stats.now() - t1)
+
+    def stats(self):
+        return {'type': 'file', 'log_file': self.log_file}
+
+    def flush(self):
+        self.fhandle.flush()
+
+    def close(self):
+        self.fhandle.close()
+
+
+class TraceLogger(object):
+    """Struct-packed binary records in an append-only trace file (see tracefile)"""
+    STATES = {state: i for i, state in enumerate(tracefile.STATES)}
+
+    def __init__(self, log_trace=None, log_all=False, log_bytes=False, log_hash=False, hash_algo='sha256'):
+        self.log_trace = log_trace
+        self.log_bytes = log_bytes
+        self.log_hash = log_hash
+        self.hash = HASHES[hash_algo]
+        # Partitions come from this GPTCache (None is gpt.CACHE); set by the LogSet
+        self.gpt_cache = None
+        self.logged_calls = set()
+        self.log_all = log_all
+
+        if os.path.dirname(self.log_trace) and not os.path.exists(os.path.dirname(self.log_trace)):
+            os.makedirs(os.path.dirname(self.log_trace))
+        self.writer = tracefile.TraceWriter(self.log_trace)
+
+    def add_call(self, call):
+        self.logged_calls.add(call)
+
+    def wants(self, call):
+        return call in self.logged_calls or self.log_all
+
+    def log(self, info):
+        t0 = stats.now()
+        writer = self.writer
+        res = info.get('_res')
+        buf = info.get('buf') or (res if isinstance(res, bytes) else b'')
+        offset = info.get('offset', 0)
+        length = info.get('length', len(buf))
+        if info['_call'] == EXTENT_CALL:
+            # Recorded as e.g. 'extent:read' spanning the whole range, with the extent's rolling hash
+            call, partition, digest = EXTENT_CALL + ':' + info['call'], info['_partition'], info['_digest']
+            timestamp, buf_length = info['_first_time'], info['_buffer_length']
+        else:
+            call, timestamp, buf_length = info['_call'], time.time(), len(buf)
+            partition = gpt.get_partitions(offset, length, self.gpt_cache) if 'offset' in info else "N/A"
+            digest = self.hash(buf).digest() if (buf and self.log_hash) else b''
+        t1 = stats.now()
+        writer.append(self.STATES[info['_state']], writer.name_id('call', call),
+                      writer.name_id('path', info.get('path', '')), timestamp, offset, length,
+                      writer.name_id('partition', partition) if partition != "N/A" else -1, buf_length,
+                      digest, writer.payload(buf) if (buf and self.log_bytes) else 0)
+        stats.record('log_format', t1 - t0)
+        stats.record('log_write', stats.now() - t1)
+
+    def stats(self):
+        return {'type': 'trace', 'log_trace': self.log_trace,
+                'records': (self.writer.end - tracefile.HEADER.size) // tracefile.RECORD.size}
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+def record_size(inserts):
+    """Approximate bytes held by one queued call: its buffers and strings"""
+    if isinstance(inserts, DeferredInserts):
+        return inserts.size
+    return sum(len(arg) for query, args in inserts for arg in args if isinstance(arg, (bytes, memoryview, str)))
+
+
+class Spill(object):
+    """Calls that overflowed the DB writer's queue, appended to a file and read back in order as it drains"""
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, 'w+b')
+        self.lock = threading.Lock()
+        self.read_pos = 0
+        self.pending = 0
+        self.spilled = 0
+        self.size = 0
+
+    def write(self, inserts):
+        # sqlite3.Binary is a memoryview, which doesn't pickle
+        data = pickle.dumps([(query, tuple(bytes(a) if isinstance(a, memoryview) else a for a in args))
+                             for query, args in inserts], pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.fh.seek(0, os.SEEK_END)
+            self.fh.write(len(data).to_bytes(4, 'little') + data)
+            self.size += 4 + len(data)
+            self.pending += 1
+            self.spilled += 1
+
+    def read(self, n):
+        """Up to n of the oldest spilled calls; the file is emptied once they're all read"""
+        with self.lock:
+            self.fh.seek(self.read_pos)
+            records = []
+            while self.pending and len(records) < n:
+                size = int.from_bytes(self.fh.read(4), 'little')
+                records.append(pickle.loads(self.fh.read(size)))
+                self.pending -= 1
+            self.size -= self.fh.tell() - self.read_pos
+            self.read_pos = self.fh.tell()
+            if not self.pending:
+                self.fh.seek(0)
+                self.fh.truncate()
+                self.read_pos = 0
+        return records
+
+    def stats(self):
+        return {'spill_pending': self.pending, 'spilled': self.spilled, 'spill_bytes': self.size}
+
+    def close(self):
+        self.fh.close()
+        os.unlink(self.path)
+
+
+class WriterTask(object):
+    """Work queued for the DB writer thread to run on its connection between commits"""
+    def __init__(self, func):
+        self.func = func
+        self.done = threading.Event()
+        self.error = None
+
+
+class DBWriter(object):
+    """Drains queued inserts on a dedicated thread, committing once per batch_size records or batch_ms.
+
+    Each call's inserts pass through prepare(inserts) just before they're executed, and after every
+    commit, committed(conn, rows) may hand back a different connection (e.g. a new segment).
+    A call arriving at a full queue is dropped (and counted), waited for ('block'), or appended to a
+    spill file ('spill'); once anything is spilled, later calls follow it there until the writer
+    has read it all back, so calls are still committed in order.
+    """
+    def __init__(self, conn, queue_size=10000, batch_size=512, batch_ms=100, committed=None, policy='drop',
+                 spill_path=None, prepare=None):
+        self.conn = conn
+        self.committed = committed
+        self.prepare = prepare
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_timeout = batch_ms / 1000.0
+        self.policy = policy
+        self.spill = Spill(spill_path) if policy == 'spill' else None
+        # Bytes of buffers queued and committed so far; only the writer thread updates the second
+        self.queued_bytes = 0
+        self.unqueued_bytes = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.written = 0
+        self.commits = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self._run, name="DBWriter", daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        info = {'queue_depth': self.depth, 'dropped': self.dropped, 'blocked': self.blocked,
+                'written': self.written, 'commits': self.commits, 'errors': self.errors}
+        if self.spill:
+            info.update(self.spill.stats())
+        return info
+
+    def memory(self):
+        return {'entries': self.depth, 'bytes': max(self.queued_bytes - self.unqueued_bytes, 0),
+                'cap': self.queue.maxsize}
+
+    def put(self, inserts):
+        """Queue the inserts (or a DeferredInserts) for one logged call; a full queue is handled by policy"""
+        size = record_size(inserts)
+        spill = self.spill
+        if spill is None or not spill.pending:
+            try:
+                self.queue.put_nowait(inserts)
+                self.queued_bytes += size
+                return
+            except queue.Full:
+                pass
+        if self.policy == 'block':
+            self.blocked += 1
+            self.queue.put(inserts)
+            self.queued_bytes += size
+        elif spill is not None:
+            spill.write(inserts() if callable(inserts) else inserts)
+        else:
+            self.dropped += 1
+
+    def run(self, func):
+        """Once everything queued so far is committed, run func(conn) on the writer thread and wait for it"""
+        task = WriterTask(func)
+        self.queue.put(task)
+        task.done.wait()
+        if task.error:
+            raise task.error
+
+    def flush(self):
+        """Block until everything queued so far is committed"""
+        self.run(None)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.spill:
+            self.spill.close()
+
+    def _unspill(self, pending, drain=False):
+        """Commit what was spilled (a batch of it, or everything)"""
+        while self.spill is not None and self.spill.pending:
+            self._commit(pending)
+            pending.extend(self.spill.read(self.batch_size))
+            self._commit(pending, spilled=True)
+            if not drain:
+                return
+
+    def _commit(self, pending, spilled=False):
+        if not pending:
+            return
+        if not spilled:
+            self.unqueued_bytes += sum(record_size(inserts) for inserts in pending)
+        # Group by query (keeping first-seen order) so each statement is prepared once per batch
+        grouped = collections.OrderedDict()
+        for inserts in pending:
+            if callable(inserts):
+                try:
+                    inserts = inserts()
+                except Exception as e:
+                    self.errors += 1
+                    print("DBWriter failed to hash/compress a record: %s" % e)
+                    continue
+            if self.prepare:
+                inserts = self.prepare(inserts)
+            for query, args in inserts:
+                grouped.setdefault(query, []).append(args)
+        try:
+            cur = self.conn.cursor()
+            for query, rows in grouped.items():
+                cur.executemany(query, rows)
+            self.conn.commit()
+            self.written += len(pending)
+            self.commits += 1
+            if self.committed:
+                self.conn = self.committed(self.conn, sum(len(rows) for rows in grouped.values()))
+        except sqlite3.Error as e:
+            self.errors += 1
+            print("DBWriter failed to commit %i records: %s" % (len(pending), e))
+        del pending[:]
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            if timeout is None and self.spill is not None and self.spill.pending:
+                # New calls are going to the spill file rather than the queue; go read them back
+                timeout = 0
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._commit(pending)
+                deadline = None
+                self._unspill(pending)
+                continue
+
+            if item is None:
+                self._commit(pending)
+                self._unspill(pending, drain=True)
+                return
+            elif isinstance(item, WriterTask):
+                self._commit(pending)
+                self._unspill(pending, drain=True)
+                deadline = None
+                try:
+                    if item.func:
+                        item.func(self.conn)
+                except Exception as e:
+                    item.error = e
+                item.done.set()
+                continue
+
+            pending.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self.batch_timeout
+            if len(pending) >= self.batch_size:
+                self._commit(pending)
+                deadline = None
 
 
 class DBLogger(object):
-    def __init__(self, log_db=None, log_all=False, log_bytes=False, log_hash=False, conf="db.conf"):
+    def __init__(self, log_db=None, log_all=False, log_bytes=False, log_hash=False, conf="db.conf",
+                 log_async=False, queue_size=10000, batch_size=512, batch_ms=100, blob_cache_size=4096,
+                 read_count_interval=5.0, hash_algo='sha256', compress=None, hash_workers=0,
+                 defer_indexes=False, max_mb=0, max_rows=0, write_diff_block=0, queue_policy='drop',
+                 max_read_counts=100000, write_diff_max_blocks=0):
         self.log_db = log_db
         self.log_bytes = log_bytes
         self.log_hash = log_hash
+        self.gpt_cache = None
         self.logged_calls = set()
         self.log_all = log_all
         self.conf = conf
 
-        if self.log_db and not os.path.exists(os.path.dirname(self.log_db)):
-            os.makedirs(os.path.dirname(self.log_db))
-        self.conn = sqlite3.connect(self.log_db)
-        self.cur = self.conn.cursor()
+        # Hashes of blobs recently stored in the current segment, so repeated buffers skip the blobs insert
+        self.blob_cache = collections.OrderedDict()
+        self.blob_cache_size = blob_cache_size
+        self.blob_lock = threading.Lock()
+        self.blob_hits = 0
+
+        # (offset, length) -> reads since the last flush; upserted into read_counts in bulk
+        self.read_counts = collections.Counter()
+        self.read_count_interval = read_count_interval
+        self.read_count_lock = threading.Lock()
+        self.last_read_count_flush = time.monotonic()
+        # ... flushed early once it holds this many distinct requests
+        self.max_read_counts = max_read_counts
+
+        # Writes are logged as the runs of blocks whose content changed; identical rewrites go to rewrite_counts
+        self.write_index = WriteIndex(write_diff_block, write_diff_max_blocks) if write_diff_block else None
 
+        if self.log_db and os.path.dirname(self.log_db) and not os.path.exists(os.path.dirname(self.log_db)):
+            os.makedirs(os.path.dirname(self.log_db))
         with open(self.conf) as fh:
             self.config = json.load(fh)
 
-        for table in self.config['db']['table_creates']:
-            self.cur.execute(table)
-        self.conn.commit()
+        # Past max_mb or max_rows the capture continues in a new segment file, listed in the manifest
+        self.log_async = log_async
+        self.defer_indexes = defer_indexes
+        self.max_bytes = max_mb << 20
+        self.max_rows = max_rows
+        self.manifest_path = self.log_db + '.manifest.json'
+        self.segments = []
+        if (self.max_bytes or self.max_rows) and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as fh:
+                self.segments = json.load(fh)['segments']
+        if not self.segments:
+            self.segments.append({'path': os.path.basename(self.log_db), 'opened': time.time(),
+                                  'closed': None, 'rows': 0})
+        self.segment = self.segments[-1]
+        self.segment['closed'] = None
+
+        # The connection is shared between FUSE threads (behind self.lock) or handed to the writer thread
+        self.conn = self.connect(self.segment_path(self.segment))
+        self.cur = self.conn.cursor()
+        self.lock = threading.Lock()
+        self.write_manifest()
+
+        queries = self.config['db']['queries']
+        self.call_queries = self.compile(queries['call'])
+        self.blob_queries = self.compile(queries['blob'])
+        # blob insert -> position of the blob's hash in its args
+        self.blob_hashes = dict((query['query'], query['args'].index('_buffer_hash')) for query in queries['blob'])
+
+        self.writer = DBWriter(self.conn, queue_size, batch_size, batch_ms, self.committed, queue_policy,
+                               self.log_db + '.spill', self.dedup) if log_async else None
+        self.plans = {}
+
+        # Per call type hash algorithm and compression: config db.digests overrides the command line
+        # (null keeps the command line setting, "none" turns compression off for that call)
+        self.default_digest = (hash_algo, compress)
+        self.digests = {}
+        for call, opts in self.config['db'].get('digests', {}).items():
+            compression = opts.get('compress') or compress
+            self.digests[call] = (opts.get('hash') or hash_algo, None if compression == 'none' else compression)
+        # Hashing/compression only leaves the FUSE thread when there's a writer thread to finish the record
+        self.pool = ThreadPoolExecutor(hash_workers, thread_name_prefix="Digest") \
+            if (hash_workers and self.writer) else None
+
+        # Flushes read_counts every read_count_interval, even while no calls arrive
+        self.stopped = threading.Event()
+        self.flusher = None
+        if read_count_interval > 0:
+            self.flusher = threading.Thread(target=self._flush_periodically, name="ReadCounts", daemon=True)
+            self.flusher.start()
 
     def add_call(self, call):
         self.logged_calls.add(call)
+        self.plans.clear()
+
+    def connect(self, path):
+        conn = sqlite3.connect(path, check_same_thread=False)
+        pragmas = dict((k, v) for k, v in self.config['db'].get('pragmas', {}).items() if v is not None)
+        if self.log_async:
+            # The writer commits often from its own thread; WAL keeps readers of a live capture unblocked
+            pragmas.setdefault('journal_mode', 'WAL')
+        # page_size only applies to a new database, before its first table and before WAL
+        if 'page_size' in pragmas:
+            conn.execute("PRAGMA page_size=%s" % pragmas.pop('page_size'))
+        for name, value in pragmas.items():
+            conn.execute("PRAGMA %s=%s" % (name, value))
+        for table in self.config['db']['table_creates']:
+            conn.execute(table)
+        if not self.defer_indexes:
+            self.create_indexes(conn)
+        conn.commit()
+        return conn
+
+    def create_indexes(self, conn):
+        for index in self.config['db'].get('index_creates', []):
+            conn.execute(index)
+        conn.commit()
+
+    def segment_path(self, segment):
+        return os.path.join(os.path.dirname(self.log_db), segment['path'])
+
+    def write_manifest(self):
+        if not (self.max_bytes or self.max_rows):
+            return
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'segments': self.segments}, fh, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def segment_full(self, conn):
+        """Checked after each commit, so a segment can overshoot max_rows/max_mb by up to one batch"""
+        if self.max_rows and self.segment['rows'] >= self.max_rows:
+            return True
+        if self.max_bytes:
+            (pages,), = conn.execute("PRAGMA page_count").fetchall()
+            (page_size,), = conn.execute("PRAGMA page_size").fetchall()
+            return pages * page_size >= self.max_bytes
+        return False
+
+    def committed(self, conn, rows):
+        """After each commit, on whichever thread owns conn: start a new segment once this one is full"""
+        self.segment['rows'] += rows
+        if not (self.max_bytes or self.max_rows) or not self.segment_full(conn):
+            return conn
+        self.close_segment(conn)
+        root, ext = os.path.splitext(os.path.basename(self.log_db))
+        self.segment = {'path': '%s.%i%s' % (root, len(self.segments), ext), 'opened': time.time(),
+                        'closed': None, 'rows': 0}
+        self.segments.append(self.segment)
+        # Each segment stores its own copy of the blobs its rows refer to
+        with self.blob_lock:
+            self.blob_cache.clear()
+        self.conn = self.connect(self.segment_path(self.segment))
+        self.cur = self.conn.cursor()
+        self.write_manifest()
+        print("Logging to new DB segment %s" % self.segment['path'])
+        return self.conn
+
+    def close_segment(self, conn):
+        if self.defer_indexes:
+            self.create_indexes(conn)
+        conn.close()
+        self.segment['closed'] = time.time()
+        self.write_manifest()
+
+    @staticmethod
+    def compile(queries):
+        """Turn config queries into (sql, extractor) pairs, the extractor pulling the args tuple from info"""
+        compiled = []
+        for query in queries:
+            args = query['args']
+            getter = operator.itemgetter(*args)
+            extract = getter if len(args) > 1 else (lambda info, getter=getter: (getter(info),))
+            compiled.append((query['query'], extract))
+        return compiled
+
+    def plan(self, call):
+        """(log to func_calls?, compiled data queries) for a call, worked out once per call name"""
+        if call not in self.plans:
+            queries = self.config['db']['queries'].get(call) if call in self.logged_calls else None
+            self.plans[call] = (self.log_all, self.compile(queries) if queries else [])
+        return self.plans[call]
+
+    def wants(self, call):
+        log_call, data_queries = self.plan(call)
+        return log_call or bool(data_queries)
+
+    def seen_blob(self, blob_hash):
+        """Check (and record) whether a blob was stored recently"""
+        with self.blob_lock:
+            if blob_hash in self.blob_cache:
+                self.blob_cache.move_to_end(blob_hash)
+                self.blob_hits += 1
+                return True
+            self.blob_cache[blob_hash] = True
+            if len(self.blob_cache) > self.blob_cache_size:
+                self.blob_cache.popitem(last=False)
+            return False
+
+    def count_read(self, offset, length):
+        with self.read_count_lock:
+            self.read_counts[(offset, length)] += 1
+        self.maybe_flush_read_counts()
+
+    def maybe_flush_read_counts(self):
+        if time.monotonic() - self.last_read_count_flush >= self.read_count_interval or \
+                (self.max_read_counts and len(self.read_counts) >= self.max_read_counts):
+            self.flush_read_counts()
 
-    def make_composite_key(self, offset, length):
-        """Make a composite key. Assumes: offset < 2**40, length % 4096 == 0, length < 2**20"""
-        return (offset << 8) + (length >> 12)
+    def _flush_periodically(self):
+        while not self.stopped.wait(max(self.last_read_count_flush + self.read_count_interval - time.monotonic(),
+                                        0.01)):
+            try:
+                self.maybe_flush_read_counts()
+            except sqlite3.Error as e:
+                print("DBLogger failed to flush read_counts: %s" % e)
+
+    def flush_read_counts(self):
+        with self.read_count_lock:
+            counts, self.read_counts = self.read_counts, collections.Counter()
+            self.last_read_count_flush = time.monotonic()
+        rewrites = self.write_index.take_rewrites() if self.write_index else {}
+        if not (counts or rewrites):
+            return
+        inserts = []
+        for query in self.config['db']['queries']['read_counts']:
+            for (offset, length), count in counts.items():
+                row = {'offset': offset, 'length': length, 'count': count}
+                inserts.append((query['query'], tuple(row[i] for i in query['args'])))
+        for query in self.config['db']['queries']['rewrite_counts'] if rewrites else ():
+            for (path, offset), count in rewrites.items():
+                row = {'path': path, 'offset': offset, 'length': self.write_index.block_size, 'count': count}
+                inserts.append((query['query'], tuple(row[i] for i in query['args'])))
+        self.execute(inserts)
 
     def format(self, info):
-        # Handle log_all separately
         inserts = []
-        if self.log_all:
+        log_call, data_queries = self.plan(info['_call'])
+        if log_call:
             kwargs = {k: str(v)[:500] for k, v in info.items() if k[0] != '_'}
             info['_kwargs'] = json.dumps(kwargs)
+            info['_retval'] = str(info.get('_res'))[:500]
+            inserts.extend((sql, extract(info)) for sql, extract in self.call_queries)
 
-        queries = [self.config['db']['queries']['call']] if self.log_all else []
-        if info['_call'] in self.logged_calls:
-            queries += self.config['db']['queries'][info['_call']]
-
+        if data_queries and info['_call'] != EXTENT_CALL:
+            call = info['_call']
             # Normalize call return buffer
             res = info.get('_res')
             if info.get('buf'):             # write operations
@@ -104,64 +828,479 @@ class DBLogger(object):
                 buf = res
             elif isinstance(res, str):
                 buf = res.encode('utf8')
-            elif isinstance(res, types.GeneratorType):
-                _res = [i for i in res]
-                buf = str(_res).encode('utf8')
             else:
                 buf = str(res).encode('utf8')
-            blob = Blob(buf, self.log_bytes, self.log_hash)
-            info['_buffer'] = blob.blob
-            info['_buffer_length'] = blob.length
-            info['_buffer_hash'] = blob.sha256
-            info['_composite_key'] = self.make_composite_key(info['offset'], info.get('length', blob.length))
-            info['_partition'] = gpt.get_partition(info['offset'])
+            info['_partition'] = gpt.get_partitions(info['offset'], info.get('length', len(buf)), self.gpt_cache)
+            info['_file'] = fsindex.get_files(info.get('path'), info['offset'], info.get('length', len(buf)))
+            info['_time'] = time.time()
+            if call == 'read':
+                self.count_read(info['offset'], info['length'])
 
-        for query in queries:
-            inserts.append((query['query'], tuple(info[i] for i in query['args'])))
+            if call == 'write' and self.write_index and info['_state'] == 'post-run':
+                runs = self.write_index.diff(info.get('path'), buf, info['offset'])
+                self.maybe_flush_read_counts()
+                if len(runs) == 1 and runs[0][1] is buf:
+                    infos = [info]
+                else:
+                    infos = [dict(info, offset=offset, length=len(data), buf=data,
+                                  _partition=gpt.get_partitions(offset, len(data), self.gpt_cache))
+                             for offset, data in runs]
+                bufs = [data for offset, data in runs]
+            else:
+                infos, bufs = [info], [buf]
+
+            algorithm, compression = self.digests.get(call, self.default_digest)
+            if self.pool:
+                future = self.pool.submit(digests, bufs, self.log_bytes, self.log_hash, algorithm, compression)
+                return DeferredInserts(self, inserts, future, infos, data_queries, bufs)
+            for run, data in zip(infos, bufs):
+                run.update(digest(data, self.log_bytes, self.log_hash, algorithm, compression))
+                inserts.extend(self.blob_inserts(run))
+                inserts.extend((sql, extract(run)) for sql, extract in data_queries)
+            return inserts
+
+        if data_queries:
+            inserts.extend((sql, extract(info)) for sql, extract in data_queries)
 
         return inserts
 
+    def blob_inserts(self, info):
+        """Rows reference their bytes by hash; the blob itself is stored once per segment (see dedup)"""
+        if self.log_bytes and info['_buffer_length']:
+            return [(sql, extract(info)) for sql, extract in self.blob_queries]
+        return []
+
+    def dedup(self, inserts):
+        """Drop inserts of blobs the current segment already has, on the thread about to execute them.
+
+        Deciding when the call is formatted could skip a blob whose row is then committed to the
+        next segment, after a rotation cleared blob_cache.
+        """
+        if not self.log_bytes:
+            return inserts
+        blob_hashes = self.blob_hashes
+        return [(sql, args) for sql, args in inserts
+                if sql not in blob_hashes or not self.seen_blob(args[blob_hashes[sql]])]
+
+    def execute(self, inserts):
+        if self.writer:
+            if inserts:
+                self.writer.put(inserts)
+            return
+        with self.lock:
+            inserts = self.dedup(inserts)
+            for query, args in inserts:
+                self.cur.execute(query, args)
+            self.conn.commit()
+            self.committed(self.conn, len(inserts))
+
     def log(self, info):
-        for query, args in self.format(info):
-            self.cur.execute(query, args)
-        self.conn.commit()
+        t0 = stats.now()
+        inserts = self.format(info)
+        t1 = stats.now()
+        self.execute(inserts)
+        stats.record('log_format', t1 - t0)
+        stats.record('log_write', stats.now() - t1)
+
+    def stats(self):
+        info = {'type': 'db', 'log_db': self.log_db, 'blob_cache_hits': self.blob_hits,
+                'segment': self.segment['path'], 'segments': len(self.segments),
+                'segment_rows': self.segment['rows']}
+        if self.write_index:
+            info['write_diff'] = self.write_index.stats()
+        if self.writer:
+            info.update(self.writer.stats())
+        return info
+
+    def memory(self):
+        # Rough per entry sizes: a (offset, length) key and count; a 64 char hex digest in an OrderedDict
+        info = {'read_counts': stats.usage(len(self.read_counts), 200, self.max_read_counts or None),
+                'blob_cache': stats.usage(len(self.blob_cache), 220, self.blob_cache_size)}
+        if self.write_index:
+            info['write_index'] = self.write_index.memory()
+        if self.writer:
+            info['queue'] = self.writer.memory()
+        return info
+
+    def flush(self):
+        """Commit everything logged so far, building any deferred indexes so the capture can be queried"""
+        self.flush_read_counts()
+        if self.writer:
+            self.writer.run(self.create_indexes if self.defer_indexes else None)
+        elif self.defer_indexes:
+            with self.lock:
+                self.create_indexes(self.conn)
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush_read_counts()
+        if self.writer:
+            # The writer waits on any digests still running on the pool
+            self.writer.close()
+            print("DBWriter stats: %s" % json.dumps(self.writer.stats()))
+        if self.pool:
+            self.pool.shutdown()
+        self.close_segment(self.conn)
+
+
+class Extent(object):
+    """A run of contiguous, same-path, same-partition requests"""
+    def __init__(self, call, path, partition, offset, now, hasher=None):
+        self.call = call
+        self.path = path
+        self.partition = partition
+        self.start = self.end = offset
+        self.requests = 0
+        self.first_time = self.last_time = now
+        # Rolling hash over the extent's bytes in order, i.e. the hash of the whole range
+        self.hash = hasher() if hasher else None
+
+    def add(self, buf, now):
+        self.end += len(buf)
+        self.requests += 1
+        self.last_time = now
+        if self.hash:
+            self.hash.update(buf)
+
+    def info(self):
+        digest = self.hash.digest() if self.hash else b''
+        return {'_call': EXTENT_CALL, '_state': 'post-run', 'call': self.call, 'path': self.path,
+                'offset': self.start, 'length': self.end - self.start, 'requests': self.requests,
+                '_partition': self.partition, '_digest': digest, '_buffer_hash': digest.hex() if digest else b'',
+                '_buffer_length': self.end - self.start, '_end': self.end,
+                '_first_time': self.first_time, '_last_time': self.last_time}
+
+
+class Coalescer(object):
+    """Merges contiguous reads (or writes) into extent records ahead of the loggers.
+
+    An open extent per (call, path) grows while requests continue exactly where it ends, stay in
+    the same partition(s) and arrive within `window` seconds of the previous one. Anything else
+    flushes it as one EXTENT_CALL record. Failed calls are passed through unmerged.
+
+    Extents keep a hash of their bytes but not the bytes, so --log_bytes can't be combined with
+    it; the DB loggers' read_counts are still fed every coalesced read.
+    """
+    def __init__(self, window_ms, calls=('read', 'write'), log_hash=False, hash_algo='sha256'):
+        self.window = window_ms / 1000.0
+        self.calls = set(calls)
+        self.hasher = HASHES[hash_algo] if log_hash else None
+        self.gpt_cache = None
+        self.loggers = ()
+        # Loggers keeping a read_counts histogram
+        self.counters = ()
+        self.extents = {}
+        self.lock = threading.Lock()
+        self.merged = 0
+        self.emitted = 0
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="Coalescer", daemon=True)
+        self.thread.start()
+
+    def wants(self, call):
+        return call in self.calls and any(logger.wants(call) for logger in self.loggers)
+
+    def log(self, info):
+        if info['_state'] != 'post-run':
+            self.emit([], [info])
+            return
+        call = info['_call']
+        buf = info.get('buf') if call == 'write' else info.get('_res')
+        buf = buf if isinstance(buf, bytes) else b''
+        offset = info['offset']
+        if call == 'read':
+            for logger in self.counters:
+                logger.count_read(offset, info['length'])
+        partition = gpt.get_partitions(offset, len(buf), self.gpt_cache)
+        now = time.time()
+
+        key = (call, info.get('path'))
+        with self.lock:
+            done = self._expired(now, key)
+            extent = self.extents.get(key)
+            if extent and (extent.end != offset or extent.partition != partition
+                           or now - extent.last_time > self.window):
+                done.append(self.extents.pop(key))
+                extent = None
+            if extent is None:
+                extent = self.extents[key] = Extent(call, key[1], partition, offset, now, self.hasher)
+            else:
+                self.merged += 1
+            extent.add(buf, now)
+        self.emit(done)
+
+    def _expired(self, now, skip=None):
+        expired = [k for k, e in self.extents.items() if k != skip and now - e.last_time > self.window]
+        return [self.extents.pop(k) for k in expired]
+
+    def emit(self, extents, infos=()):
+        infos = [extent.info() for extent in extents] + list(infos)
+        self.emitted += len(extents)
+        for info in infos:
+            for logger in self.loggers:
+                logger.log(info)
+
+    def _run(self):
+        # Close out extents that went quiet even if no further requests arrive
+        while not self.stopped.wait(max(self.window, 0.05)):
+            with self.lock:
+                done = self._expired(time.time())
+            self.emit(done)
+
+    def flush(self):
+        with self.lock:
+            done = list(self.extents.values())
+            self.extents.clear()
+        self.emit(done)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def memory(self):
+        # An Extent with its running hash object
+        return stats.usage(len(self.extents), 600)
+
+    def stats(self):
+        return {'type': 'coalescer', 'open_extents': len(self.extents), 'merged_requests': self.merged,
+                'extents': self.emitted}
+
+
+def shard_path(path, shard):
+    """Per-image log file name, e.g. capture.db -> capture.sd.img.db"""
+    if not path or not shard:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, shard, ext)
+
+
+class LogSet(object):
+    """A set of loggers (plus their coalescer) and which of them every decorated call goes to.
+
+    LOGS serves the mount as a whole. Each image configured in images.py gets its own set, logging
+    to its own files, so images don't contend for one writer and their partitions come from their
+    own GPT.
+    """
+    def __init__(self, gpt_cache=None, name=None):
+        self.gpt_cache = gpt_cache
+        self.name = name
+        self.loggers = []
+        self.coalescer = None
+        # call name -> loggers (or the coalescer) it's logged to; calls nobody logs are missing
+        self.routes = {}
+
+    def init(self, args):
+        if args.coalesce_ms and args.log_bytes:
+            raise ValueError("--coalesce_ms logs extents without their bytes; it can't be used with --log_bytes")
+        shard = self.name
+        if args.log_file:
+            self.loggers.append(FileLogger(shard_path(args.log_file, shard), args.log_all))
+        if args.log_trace:
+            self.loggers.append(TraceLogger(shard_path(args.log_trace, shard), args.log_all, args.log_bytes,
+                                            args.log_hash, args.hash_algo))
+        if args.log_db:
+            self.loggers.append(DBLogger(shard_path(args.log_db, shard), args.log_all, args.log_bytes,
+                                         args.log_hash, conf=args.config,
+                                         log_async=args.log_async, queue_size=args.log_queue_size,
+                                         batch_size=args.log_batch_size, batch_ms=args.log_batch_ms,
+                                         blob_cache_size=args.blob_cache_size,
+                                         read_count_interval=args.read_count_interval, hash_algo=args.hash_algo,
+                                         compress=args.compress, hash_workers=args.hash_workers,
+                                         defer_indexes=args.defer_indexes, max_mb=args.db_max_mb,
+                                         max_rows=args.db_max_rows, write_diff_block=args.write_diff_block,
+                                         queue_policy=args.log_queue_policy, max_read_counts=args.max_read_counts,
+                                         write_diff_max_blocks=args.write_diff_max_blocks))
+        for call in args.call_log:
+            for logger in self.loggers:
+                logger.add_call(call)
+        if args.coalesce_ms and self.loggers:
+            # --write_diff_block works on individual writes, so those aren't coalesced
+            self.coalescer = Coalescer(args.coalesce_ms, ('read',) if args.write_diff_block else ('read', 'write'),
+                                       log_hash=args.log_hash, hash_algo=args.hash_algo)
+            for logger in self.loggers:
+                logger.add_call(EXTENT_CALL)
+        for logger in self.loggers + [self.coalescer]:
+            if logger is not None:
+                logger.gpt_cache = self.gpt_cache
+        self.route_calls()
+        stats.STATS.add_source('loggers' if shard is None else 'loggers.' + shard, self.stats)
+        stats.STATS.add_memory('loggers' if shard is None else 'loggers.' + shard, self.memory)
+
+    def route_calls(self):
+        coalescer = self.coalescer
+        if coalescer:
+            coalescer.loggers = tuple(logger for logger in self.loggers if logger.wants(EXTENT_CALL))
+            coalescer.counters = tuple(logger for logger in self.loggers
+                                       if hasattr(logger, 'count_read') and logger.wants('read'))
+        routes = {}
+        for route in ROUTES:
+            if coalescer and coalescer.wants(route.call):
+                routes[route.call] = (coalescer,)
+            else:
+                loggers = tuple(logger for logger in self.loggers if logger.wants(route.call))
+                if loggers:
+                    routes[route.call] = loggers
+        # Swapped in whole; the wrapper never sees a half-built table
+        self.routes = routes
+
+    def seed_writes(self, path, offset, length, read):
+        """Before a write, give the --write_diff_block indexes the current content of the blocks it covers
+        they have no digest for; read(offset, length) reads the image as it is"""
+        for logger in self.loggers:
+            index = getattr(logger, 'write_index', None)
+            if index is None or not logger.wants('write'):
+                continue
+            for start, end in index.unseen(path, offset, length):
+                try:
+                    data = read(start, end - start)
+                except OSError:
+                    # e.g. a write-only fh: those blocks are logged whole, as before
+                    return
+                index.seed(path, start, data)
+
+    def stats(self):
+        return [logger.stats() for logger in self.loggers] + ([self.coalescer.stats()] if self.coalescer else [])
+
+    def memory(self):
+        usage = {}
+        for logger in self.loggers + [self.coalescer]:
+            if logger is not None and hasattr(logger, 'memory'):
+                usage[type(logger).__name__] = logger.memory()
+        return usage
+
+    def flush(self):
+        if self.coalescer:
+            self.coalescer.flush()
+        for logger in self.loggers:
+            logger.flush()
+
+    def close(self):
+        if self.coalescer:
+            # Open extents still have to reach the loggers before they close
+            self.coalescer.close()
+            self.coalescer = None
+        while self.loggers:
+            self.loggers.pop().close()
+        self.route_calls()
+
+
+LOGS = LogSet()
+# Every LogSet in use: LOGS plus one per configured image
+LOGSETS = [LOGS]
+LOGGERS = LOGS.loggers
 
 
 def init_logging(args):
-    if args.log_file:
-        LOGGERS.append(FileLogger(args.log_file, args.log_all))
-    if args.log_db:
-        LOGGERS.append(DBLogger(args.log_db, args.log_all, args.log_bytes, args.log_hash, conf=args.config))
-    for call in args.call_log:
-        for logger in LOGGERS:
-            logger.add_call(call)
-    if not LOGGERS:
+    global MAX_LOGGED_ENTRIES
+    MAX_LOGGED_ENTRIES = args.max_logged_entries
+    LOGS.init(args)
+    if not LOGS.loggers:
         raise Exception("No logging configured!")
 
 
-def log(info):
-    for logger in LOGGERS:
+class Route(object):
+    """A decorated call, and how to name its arguments"""
+    def __init__(self, call, names):
+        self.call = call
+        self.names = names
+
+
+def route_calls():
+    """Decide, for every decorated call, which loggers it goes to. Calls nobody logs skip logging entirely."""
+    for logset in LOGSETS:
+        logset.route_calls()
+
+
+def log(info, loggers=None):
+    for logger in (LOGGERS if loggers is None else loggers):
         logger.log(info)
 
 
+@control.command('flush')
+def flush_logging():
+    for logset in LOGSETS:
+        logset.flush()
+    return {'flushed': sum(len(logset.loggers) for logset in LOGSETS)}
+
+
+def close_logging():
+    for logset in LOGSETS:
+        logset.close()
+    del LOGSETS[1:]
+
+
+def write_indexes():
+    for logset in LOGSETS:
+        for logger in logset.loggers:
+            if getattr(logger, 'write_index', None):
+                yield logger.write_index
+
+
+def forget_writes(path, offset=0):
+    """path was truncated to offset (or removed): its --write_diff_block digests past that are stale"""
+    for index in write_indexes():
+        index.forget(path, offset)
+
+
+def rename_writes(old, new):
+    for index in write_indexes():
+        index.rename(old, new)
+
+
 def logs(func):
+    # Look through other decorators (e.g. parse_gpt) for the real argument names, minus self
+    code = inspect.unwrap(func).__code__
+    route = Route(func.__name__, code.co_varnames[1:code.co_argcount])
+    ROUTES.append(route)
+    route_calls()
+    names = route.names
+    call = route.call
+    stage = 'call.' + func.__name__
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        info = dict(zip(func.__code__.co_varnames, args))
-        info.update(kwargs)
-        info['_call'] = func.__name__
+        # Every call is timed; only those with loggers (of the image the call's path belongs to, every
+        # decorated call's first argument being a path) are logged
+        t0 = stats.now()
+        loggers = args[0].image(args[1]).logs.routes.get(call)
+        if not loggers:
+            try:
+                res = func(*args, **kwargs)
+                # e.g. readdir: time the listing, not just creating the generator
+                return list(res) if isinstance(res, types.GeneratorType) else res
+            finally:
+                stats.record(stage, stats.now() - t0)
+
+        info = dict(zip(names, args[1:]))
+        if kwargs:
+            info.update(kwargs)
+        info['_call'] = route.call
         info['_state'] = 'pre-run'
         try:
             res = func(*args, **kwargs)
-            info['_res'] = res
+            if isinstance(res, types.GeneratorType):
+                # e.g. readdir: materialize so logging doesn't consume what FUSE needs to return
+                res = list(res)
+                # ... but only keep the start of a huge listing in the (possibly queued) record
+                info['_res'] = res if len(res) <= MAX_LOGGED_ENTRIES else \
+                    res[:MAX_LOGGED_ENTRIES] + ['... %i more' % (len(res) - MAX_LOGGED_ENTRIES)]
+            else:
+                info['_res'] = res
             info['_state'] = 'post-run'
 
             # Log and return
-            log(info)
+            log(info, loggers)
             return res
         except Exception as e:
             info['_state'] = 'error'
             info['buf'] = str(e).encode('utf8')
-            log(info)
+            log(info, loggers)
             raise
+        finally:
+            stats.record(stage, stats.now() - t0)
 
     return wrapper
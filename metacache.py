@@ -0,0 +1,129 @@
+"""Short-lived cache of lstat, listdir and access results for Passthrough's metadata calls.
+
+Hosts and the kernel probe getattr/readdir/access constantly; within `ttl` seconds the answer
+(including "no such file") comes from memory. Passthrough invalidates the affected paths on every
+call that changes them, so the TTL only bounds changes made to the backing files behind its back.
+"""
+
+import os
+import threading
+import time
+
+import stats
+
+
+def meta_key(path):
+    """Passthrough's path for the mount root ends in '/'; the dirname of its children doesn't"""
+    return path.rstrip('/') or '/'
+
+
+class MetaCache(object):
+    def __init__(self, ttl=0, max_entries=100000):
+        self.ttl = ttl
+        # Per table; past it expired entries are purged, and if that isn't enough the table is emptied
+        self.max_entries = max_entries
+        self.purges = 0
+        self.attrs = {}
+        self.dirs = {}
+        # path -> {mode: entry}
+        self.access = {}
+        self.lock = threading.Lock()
+        # Bumped by every invalidation; a lookup that raced one doesn't store its (maybe stale) result
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def lookup(self, table, key, load):
+        """load(), or its cached result (an OSError is cached and re-raised too)"""
+        if not self.ttl:
+            return load()
+        now = time.monotonic()
+        entry = table.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            value, error = entry[1], entry[2]
+            if error:
+                raise OSError(error, os.strerror(error))
+            return value
+        self.misses += 1
+        generation = self.generation
+        try:
+            value, error = load(), None
+        except OSError as e:
+            value, error = None, e.errno
+            raise
+        finally:
+            with self.lock:
+                if generation == self.generation:
+                    if self.max_entries and len(table) >= self.max_entries:
+                        self.purge(table, now)
+                    table[key] = (now + self.ttl, value, error)
+        return value
+
+    def purge(self, table, now):
+        for key in [k for k, entry in table.items() if entry[0] <= now]:
+            del table[key]
+        if len(table) >= self.max_entries:
+            table.clear()
+        self.purges += 1
+
+    def getattr(self, path, load):
+        return self.lookup(self.attrs, meta_key(path), load)
+
+    def listdir(self, path, load):
+        return self.lookup(self.dirs, meta_key(path), load)
+
+    def check_access(self, path, mode, load):
+        if not self.ttl:
+            return load()
+        path = meta_key(path)
+        modes = self.access.get(path)
+        if modes is None:
+            if self.max_entries and len(self.access) >= self.max_entries:
+                with self.lock:
+                    self.access.clear()
+                    self.purges += 1
+            modes = self.access.setdefault(path, {})
+        return self.lookup(modes, mode, load)
+
+    def invalidate(self, *paths):
+        """Forget paths, and the listings and attributes of the directories holding them"""
+        if not self.ttl:
+            return
+        with self.lock:
+            self.generation += 1
+            for path in map(meta_key, paths):
+                parent = os.path.dirname(path)
+                for table in (self.attrs, self.dirs, self.access):
+                    if table.pop(path, None) is not None:
+                        self.invalidations += 1
+                self.attrs.pop(parent, None)
+                self.dirs.pop(parent, None)
+
+    def invalidate_tree(self, *paths):
+        """Forget paths and everything under them (a renamed or removed directory)"""
+        if not self.ttl:
+            return
+        self.invalidate(*paths)
+        prefixes = tuple(meta_key(path).rstrip('/') + '/' for path in paths)
+        with self.lock:
+            self.generation += 1
+            for table in (self.attrs, self.dirs, self.access):
+                for key in [k for k in table if k.startswith(prefixes)]:
+                    del table[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'ttl': self.ttl, 'attrs': len(self.attrs), 'dirs': len(self.dirs), 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'invalidations': self.invalidations, 'purges': self.purges}
+
+    def memory(self):
+        # An lstat dict of 8 ints; a listing is a list of names (~80 bytes each)
+        names = sum(len(entry[1] or ()) for entry in list(self.dirs.values()))
+        return {'attrs': stats.usage(len(self.attrs), 900, self.max_entries),
+                'dirs': {'entries': len(self.dirs), 'bytes': len(self.dirs) * 200 + names * 80,
+                         'cap': self.max_entries},
+                'access': stats.usage(len(self.access), 400, self.max_entries)}
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Block-level copy-on-write overlays, so host writes never touch the backing image.
+
+Each overlaid image gets a sparse <name>.overlay file laid out like the image and a <name>.overlay.map
+holding the image's current size and one byte per block (1 = the block lives in the overlay). A read
+looks at the map slice covering the request once and is served from the base, the overlay, or a
+run-by-run merge of the two. Partially written blocks are copied from the base first.
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import threading
+
+import control
+import stats
+
+SIZE = struct.Struct('<Q')
+COPY_CHUNK = 1 << 20
+
+OVERLAY_DIR = None
+BLOCK_SIZE = 4096
+# Absolute backing path -> Overlay, opened on first use
+OVERLAYS = {}
+OVERLAYS_LOCK = threading.Lock()
+
+
+def pread_full(fd, length, offset):
+    """pread that reads past the end of a file as zeroes"""
+    data = os.pread(fd, length, offset)
+    if len(data) < length:
+        data += b'\0' * (length - len(data))
+    return data
+
+
+def read_map(map_path):
+    """(size, block map) stored for an overlay"""
+    with open(map_path, 'rb') as fh:
+        data = fh.read()
+    return SIZE.unpack_from(data)[0], bytearray(data[SIZE.size:])
+
+
+def runs(blocks, first=0, last=None):
+    """(start, end, overlaid) runs of equal map entries in blocks[first:last]"""
+    last = len(blocks) if last is None else last
+    i = first
+    while i < last:
+        flag = blocks[i]
+        j = i + 1
+        while j < last and blocks[j] == flag:
+            j += 1
+        yield i, j, flag
+        i = j
+
+
+def copy_overlay(src, dst, block_size):
+    """Copy an overlay and its map, writing only the overlaid blocks so dst stays sparse"""
+    size, blocks = read_map(src + '.map')
+    in_fd = os.open(src, os.O_RDONLY)
+    out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        for start, end, overlaid in runs(blocks):
+            if not overlaid:
+                continue
+            for pos in range(start * block_size, end * block_size, COPY_CHUNK):
+                data = os.pread(in_fd, min(COPY_CHUNK, end * block_size - pos), pos)
+                if data:
+                    os.pwrite(out_fd, data, pos)
+        os.ftruncate(out_fd, os.fstat(in_fd).st_size)
+    finally:
+        os.close(in_fd)
+        os.close(out_fd)
+    shutil.copyfile(src + '.map', dst + '.map')
+
+
+class Overlay(object):
+    def __init__(self, base_path, overlay_path, block_size=4096):
+        self.base_path = base_path
+        self.overlay_path = overlay_path
+        self.map_path = overlay_path + '.map'
+        self.block_size = block_size
+        # Writers serialize on the lock; reads only slice the map
+        self.lock = threading.Lock()
+        self.base_fd = os.open(base_path, os.O_RDONLY)
+        self.fd = os.open(overlay_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            self.size, self.blocks = read_map(self.map_path)
+        except (OSError, struct.error):
+            self.size, self.blocks = os.fstat(self.base_fd).st_size, bytearray()
+        self.grow_map()
+
+    def grow_map(self):
+        needed = -(-self.size // self.block_size)
+        if needed > len(self.blocks):
+            self.blocks.extend(bytes(needed - len(self.blocks)))
+
+    def save(self):
+        """Persist the map (atomically, so a crash leaves the previous one)"""
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.dirty:
+            return
+        os.fsync(self.fd)
+        tmp = self.map_path + '.tmp'
+        with open(tmp, 'wb') as fh:
+            fh.write(SIZE.pack(self.size))
+            fh.write(self.blocks)
+        os.replace(tmp, self.map_path)
+        self.dirty = False
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        if end <= offset:
+            return b''
+        bs = self.block_size
+        first, last = offset // bs, (end - 1) // bs + 1
+        blocks = self.blocks[first:last]
+        clean = blocks.count(0)
+        if clean == len(blocks):
+            return pread_full(self.base_fd, end - offset, offset)
+        if not clean:
+            return pread_full(self.fd, end - offset, offset)
+        data = bytearray()
+        for start, stop, overlaid in runs(blocks):
+            pos, run_end = max(offset, (first + start) * bs), min(end, (first + stop) * bs)
+            data += pread_full(self.fd if overlaid else self.base_fd, run_end - pos, pos)
+        return bytes(data)
+
+    def write(self, buf, offset):
+        if not buf:
+            return 0
+        bs = self.block_size
+        end = offset + len(buf)
+        with self.lock:
+            if end > self.size:
+                self.size = end
+                self.grow_map()
+            first, last = offset // bs, (end - 1) // bs
+            for block in set((first, last)):
+                if not self.blocks[block] and (offset > block * bs or end < (block + 1) * bs):
+                    os.pwrite(self.fd, pread_full(self.base_fd, bs, block * bs), block * bs)
+            written = os.pwrite(self.fd, buf, offset)
+            # Data first, then the map, so a concurrent read never sees a block before its bytes
+            self.blocks[first:last + 1] = b'\1' * (last + 1 - first)
+            self.dirty = True
+        return written
+
+    def truncate(self, length):
+        bs = self.block_size
+        with self.lock:
+            if length < self.size:
+                block = length // bs
+                if length % bs and not self.blocks[block]:
+                    os.pwrite(self.fd, pread_full(self.base_fd, length % bs, block * bs), block * bs)
+                # Everything past the new end reads back as zeroes from the truncated overlay
+                os.ftruncate(self.fd, length)
+                self.blocks[block:] = b'\1' * (len(self.blocks) - block)
+            self.size = length
+            self.grow_map()
+            self.dirty = True
+
+    def discard(self):
+        """Drop every overlaid block, going back to the pristine base image"""
+        with self.lock:
+            os.ftruncate(self.fd, 0)
+            self.size, self.blocks = os.fstat(self.base_fd).st_size, bytearray()
+            self.grow_map()
+            self.dirty = True
+            self._save()
+
+    def snapshot(self, dest):
+        with self.lock:
+            self.dirty = True
+            self._save()
+            copy_overlay(self.overlay_path, dest, self.block_size)
+
+    def restore(self, src):
+        with self.lock:
+            copy_overlay(src, self.overlay_path, self.block_size)
+            self.load()
+
+    def stats(self):
+        blocks = self.blocks
+        return {'size': self.size, 'block_size': self.block_size,
+                'overlaid_blocks': len(blocks) - blocks.count(0)}
+
+    def close(self):
+        self.save()
+        os.close(self.fd)
+        os.close(self.base_fd)
+
+
+def init_overlay(args):
+    global OVERLAY_DIR, BLOCK_SIZE
+    OVERLAY_DIR = args.overlay_dir
+    BLOCK_SIZE = args.overlay_block_size
+    if OVERLAY_DIR:
+        os.makedirs(OVERLAY_DIR, exist_ok=True)
+        stats.STATS.add_source('overlay', lambda: {p: o.stats() for p, o in list(OVERLAYS.items())})
+        # One map byte per block of each image
+        stats.STATS.add_memory('overlay', lambda: {p: {'entries': len(o.blocks), 'bytes': len(o.blocks), 'cap': None}
+                                                   for p, o in list(OVERLAYS.items())})
+
+
+def overlay_name(path):
+    return os.path.abspath(path).strip('/').replace('/', '_') + '.overlay'
+
+
+def get_overlay(path):
+    """The overlay for an image (opened on first use), or None without --overlay_dir"""
+    if not OVERLAY_DIR:
+        return None
+    path = os.path.abspath(path)
+    overlay = OVERLAYS.get(path)
+    if overlay is None:
+        with OVERLAYS_LOCK:
+            overlay = OVERLAYS.get(path)
+            if overlay is None:
+                overlay = OVERLAYS[path] = Overlay(path, os.path.join(OVERLAY_DIR, overlay_name(path)), BLOCK_SIZE)
+    return overlay
+
+
+def close_overlays():
+    with OVERLAYS_LOCK:
+        for overlay in OVERLAYS.values():
+            overlay.close()
+        OVERLAYS.clear()
+
+
+def snapshot_dir(name):
+    return os.path.join(OVERLAY_DIR, 'snapshots', os.path.basename(name))
+
+
+@control.command('overlay_snapshot')
+def snapshot(name):
+    """Copy every open overlay to <overlay_dir>/snapshots/<name>"""
+    dest = snapshot_dir(name)
+    os.makedirs(dest, exist_ok=True)
+    for path, overlay in list(OVERLAYS.items()):
+        overlay.snapshot(os.path.join(dest, overlay_name(path)))
+    return {'snapshot': dest, 'overlays': sorted(OVERLAYS)}
+
+
+@control.command('overlay_restore')
+def restore(name):
+    """Replace every open overlay with its copy in a snapshot (or discard it if the snapshot has none)"""
+    src = snapshot_dir(name)
+    if not os.path.isdir(src):
+        raise ValueError("No snapshot %r" % name)
+    for path, overlay in list(OVERLAYS.items()):
+        saved = os.path.join(src, overlay_name(path))
+        if os.path.exists(saved):
+            overlay.restore(saved)
+        else:
+            overlay.discard()
+    return {'restored': src, 'overlays': sorted(OVERLAYS)}
+
+
+@control.command('overlay_discard')
+def discard():
+    for overlay in list(OVERLAYS.values()):
+        overlay.discard()
+    return {'discarded': sorted(OVERLAYS)}
+
+
+if __name__ == '__main__':
+    # Between runs (nothing mounted): manage the overlay files directly
+    argp = argparse.ArgumentParser(description="Discard, snapshot or restore the overlays in an --overlay_dir")
+    argp.add_argument('overlay_dir', help="Directory given to --overlay_dir")
+    argp.add_argument('action', choices=['discard', 'snapshot', 'restore'])
+    argp.add_argument('name', nargs='?', help="Snapshot name")
+    argp.add_argument('--overlay_block_size', type=int, default=4096, help="Block size the overlays were made with")
+    args = argp.parse_args()
+    OVERLAY_DIR = args.overlay_dir
+    names = [n for n in os.listdir(args.overlay_dir) if n.endswith('.overlay')]
+    if args.action == 'discard':
+        for n in names:
+            for f in (n, n + '.map'):
+                if os.path.exists(os.path.join(args.overlay_dir, f)):
+                    os.unlink(os.path.join(args.overlay_dir, f))
+    elif args.action == 'snapshot':
+        os.makedirs(snapshot_dir(args.name), exist_ok=True)
+        for n in names:
+            copy_overlay(os.path.join(args.overlay_dir, n), os.path.join(snapshot_dir(args.name), n),
+                         args.overlay_block_size)
+    else:
+        for n in os.listdir(snapshot_dir(args.name)):
+            if n.endswith('.overlay'):
+                copy_overlay(os.path.join(snapshot_dir(args.name), n), os.path.join(args.overlay_dir, n),
+                             args.overlay_block_size)
+    print("%s: %s" % (args.action, ', '.join(names) or 'no overlays'))
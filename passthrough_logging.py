@@ -3,72 +3,167 @@
 from __future__ import with_statement
 
 import argparse
-import os
 import errno
+import mmap
+import os
+import threading
 
 from fuse import FUSE, FuseOSError, Operations
 
-from logger import logs, init_logging
-from injector import inject, init_injector
-from gpt import parse_gpt, READS
+import cache
+import control
+import fsindex
+import stats
+from metacache import MetaCache
+from logger import logs, init_logging, close_logging, forget_writes, rename_writes, QUEUE_POLICIES
+from injector import init_injector
+from gpt import parse_gpt, watch_gpt, init_gpt
+from images import default_image, load_images, reload_on_sighup
+from overlay import init_overlay, get_overlay, close_overlays, OVERLAYS
 
 class Passthrough(Operations):
-    def __init__(self, root, second_root=None, switch_after=1):
+    def __init__(self, root, second_root=None, switch_after=1, use_mmap=False, images=None, meta_ttl=0,
+                 meta_max_entries=100000):
         self.root = root
         self.second_root = second_root
         self.switch_after = switch_after
 
-        self.initial_gpt_reads = len(READS)
+        # lstat/listdir/access results, invalidated by every call below that changes them
+        self.meta = MetaCache(meta_ttl, meta_max_entries)
+        if meta_ttl:
+            stats.STATS.add_source('meta', self.meta.stats)
+            stats.STATS.add_memory('meta', self.meta.memory)
+
+        # path -> Image with its own GPT, injector and loggers; other paths share the default image
+        self.images = images or {}
+        self.default_image = default_image()
+
+        # GPTCache -> its GPT reads before the mount, per image
+        self.initial_gpt_reads = dict((image.gpt, image.gpt.probes)
+                                      for image in list(self.images.values()) + [self.default_image])
 
-    @property
-    def read_count(self):
-        return len(READS) - self.initial_gpt_reads
+        # fh -> read-only mmap of the backing file (or None if it can't be mapped), created on first read
+        self.use_mmap = use_mmap
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+
+        # fh -> copy-on-write overlay its reads and writes go through (with --overlay_dir)
+        self.overlaid = {}
+        # fh -> absolute path of the file it reads, naming its blocks in the block cache
+        self.names = {}
+
+    def read_count(self, path):
+        """GPT reads (of offset 0) since the mount, of the image at path only"""
+        cache = self.image(path).gpt
+        return cache.probes - self.initial_gpt_reads.get(cache, 0)
 
     # Helpers
     # =======
 
+    def image(self, path):
+        return self.images.get(path, self.default_image)
+
     def _full_path(self, partial):
+        switch = self.second_root and self.read_count(partial) > self.switch_after
         partial = partial.lstrip("/")
-        if self.read_count > self.switch_after and self.second_root:
+        if switch:
             path = os.path.join(self.second_root, partial)
         else:
             path = os.path.join(self.root, partial)
         return path
 
+    def _pread(self, fh, length, offset):
+        """Unlogged, uninjected read of the image behind fh"""
+        overlay = self.overlaid.get(fh)
+        if overlay is not None:
+            return overlay.read(offset, length)
+        return os.pread(fh, length, offset)
+
+    def _mapped(self, fh):
+        try:
+            return self.maps[fh]
+        except KeyError:
+            pass
+        with self.maps_lock:
+            if fh not in self.maps:
+                try:
+                    self.maps[fh] = mmap.mmap(fh, 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    # Empty, write-only or unmappable files are read with pread
+                    self.maps[fh] = None
+            return self.maps[fh]
+
+    def _unmap(self, fh):
+        """Drop the mmap for fh"""
+        with self.maps_lock:
+            m = self.maps.pop(fh, None)
+        if m is not None:
+            m.close()
+
+    def _unmap_file(self, name):
+        """Drop every mmap of the file at absolute path name; hold maps_lock until it's truncated.
+
+        Pages past the new end of file would SIGBUS. A read still holding one of these maps gets a
+        ValueError from the closed map instead and falls back to pread, and no new map is made
+        until the lock is released.
+        """
+        for fh in [fh for fh, n in list(self.names.items()) if n == name]:
+            m = self.maps.pop(fh, None)
+            if m is not None:
+                m.close()
+
     # Filesystem methods
     # ==================
 
     @logs
     def access(self, path, mode):
         full_path = self._full_path(path)
-        if not os.access(full_path, mode):
+        if not self.meta.check_access(full_path, mode, lambda: os.access(full_path, mode)):
             raise FuseOSError(errno.EACCES)
 
+    # Calls that change metadata invalidate it once the change is made: a lookup racing the call
+    # can't then cache the old result, as MetaCache doesn't store lookups that raced an invalidation
+
     @logs
     def chmod(self, path, mode):
         full_path = self._full_path(path)
-        return os.chmod(full_path, mode)
+        try:
+            return os.chmod(full_path, mode)
+        finally:
+            self.meta.invalidate(full_path)
 
     @logs
     def chown(self, path, uid, gid):
         full_path = self._full_path(path)
-        return os.chown(full_path, uid, gid)
+        try:
+            return os.chown(full_path, uid, gid)
+        finally:
+            self.meta.invalidate(full_path)
+
+    def _lstat(self, full_path):
+        st = os.lstat(full_path)
+        attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        overlay = OVERLAYS.get(os.path.abspath(full_path))
+        if overlay is not None:
+            attrs['st_size'] = overlay.size
+        return attrs
+
+    def _listdir(self, full_path):
+        dirents = ['.', '..']
+        if os.path.isdir(full_path):
+            dirents.extend(os.listdir(full_path))
+        return dirents
 
     @logs
     def getattr(self, path, fh=None):
         full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        return self.meta.getattr(full_path, lambda: self._lstat(full_path))
 
     @logs
     def readdir(self, path, fh):
         full_path = self._full_path(path)
-
-        dirents = ['.', '..']
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
-        for r in dirents:
+        for r in self.meta.listdir(full_path, lambda: self._listdir(full_path)):
             yield r
 
     @logs
@@ -82,16 +177,25 @@ class Passthrough(Operations):
 
     @logs
     def mknod(self, path, mode, dev):
-        return os.mknod(self._full_path(path), mode, dev)
+        try:
+            return os.mknod(self._full_path(path), mode, dev)
+        finally:
+            self.meta.invalidate(self._full_path(path))
 
     @logs
     def rmdir(self, path):
         full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        try:
+            return os.rmdir(full_path)
+        finally:
+            self.meta.invalidate_tree(full_path)
 
     @logs
     def mkdir(self, path, mode):
-        return os.mkdir(self._full_path(path), mode)
+        try:
+            return os.mkdir(self._full_path(path), mode)
+        finally:
+            self.meta.invalidate(self._full_path(path))
 
     @logs
     def statfs(self, path):
@@ -103,74 +207,168 @@ class Passthrough(Operations):
 
     @logs
     def unlink(self, path):
-        return os.unlink(self._full_path(path))
+        try:
+            os.unlink(self._full_path(path))
+        finally:
+            self.meta.invalidate(self._full_path(path))
+        forget_writes(path)
 
     @logs
     def symlink(self, name, target):
-        return os.symlink(name, self._full_path(target))
+        try:
+            return os.symlink(name, self._full_path(target))
+        finally:
+            self.meta.invalidate(self._full_path(target))
 
     @logs
     def rename(self, old, new):
-        return os.rename(self._full_path(old), self._full_path(new))
+        try:
+            os.rename(self._full_path(old), self._full_path(new))
+        finally:
+            self.meta.invalidate_tree(self._full_path(old), self._full_path(new))
+        rename_writes(old, new)
 
     @logs
     def link(self, target, name):
-        return os.link(self._full_path(target), self._full_path(name))
+        try:
+            return os.link(self._full_path(target), self._full_path(name))
+        finally:
+            # Both names share the inode, whose st_nlink changes
+            self.meta.invalidate(self._full_path(target), self._full_path(name))
 
     @logs
     def utimens(self, path, times=None):
-        return os.utime(self._full_path(path), times)
+        try:
+            return os.utime(self._full_path(path), times)
+        finally:
+            self.meta.invalidate(self._full_path(path))
 
     # File methods
     # ============
 
     @logs
     def open(self, path, flags):
-        full_path = self._full_path(path)
-        return os.open(full_path, flags)
+        return self._open(path, flags)
 
     @logs
     def create(self, path, mode, fi=None):
+        return self._open(path, os.O_WRONLY | os.O_CREAT, mode)
+
+    def _open(self, path, flags, mode=0o777):
+        """Open (or create) the file behind path, registering the fh's overlay and name"""
         full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        overlay = get_overlay(full_path) if os.path.isfile(full_path) else None
+        if overlay is None:
+            if flags & os.O_TRUNC:
+                with self.maps_lock:
+                    self._unmap_file(os.path.abspath(full_path))
+                    fh = os.open(full_path, flags, mode)
+                cache.drop(os.path.abspath(full_path))
+            else:
+                fh = os.open(full_path, flags, mode)
+        else:
+            # The base image is only ever read; writes land in the overlay
+            fh = os.open(full_path, flags & ~(os.O_WRONLY | os.O_RDWR | os.O_TRUNC | os.O_APPEND), mode)
+            if flags & os.O_TRUNC:
+                overlay.truncate(0)
+                cache.drop(os.path.abspath(full_path))
+            self.overlaid[fh] = overlay
+        if flags & (os.O_TRUNC | os.O_CREAT):
+            self.meta.invalidate(full_path)
+        if flags & os.O_TRUNC:
+            forget_writes(path)
+        self.names[fh] = os.path.abspath(full_path)
+        return fh
 
     @logs
     @parse_gpt
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        orig_data = os.read(fh, length)
-        new_data = inject(path, length, offset, orig_data)
+        t0 = stats.now()
+        orig_data = None
+        m = self._mapped(fh) if (self.use_mmap and fh not in self.overlaid) else None
+        if m is not None:
+            try:
+                if offset + length <= len(m):
+                    # No syscall; this slice is the one copy fusepy needs (it memmoves from bytes)
+                    orig_data = m[offset:offset + length]
+            except ValueError:
+                # Unmapped by a concurrent truncate/release
+                orig_data = None
+        if orig_data is None:
+            # Positional I/O: with --threads several requests can share fh, so a seek would race
+            orig_data = cache.cached_read(self.names.get(fh), self._pread, fh, length, offset)
+        t1 = stats.now()
+        new_data = self.image(path).injector.handle(path, length, offset, orig_data)
+        stats.record('backing_read', t1 - t0)
+        stats.record('inject', stats.now() - t1)
+        stats.add('bytes_read', len(new_data))
         return new_data
 
     @logs
+    @watch_gpt
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        return os.write(fh, buf)
+        t0 = stats.now()
+        # --write_diff_block compares the write with what it overwrites
+        self.image(path).logs.seed_writes(path, offset, len(buf), lambda start, length: self._pread(fh, length, start))
+        overlay = self.overlaid.get(fh)
+        written = overlay.write(buf, offset) if overlay is not None else os.pwrite(fh, buf, offset)
+        cache.invalidate(self.names.get(fh), offset, len(buf))
+        self.meta.invalidate(self._full_path(path))
+        stats.record('backing_write', stats.now() - t0)
+        stats.add('bytes_written', written)
+        return written
 
     @logs
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
-        with open(full_path, 'r+') as f:
-            f.truncate(length)
+        overlay = get_overlay(full_path) if os.path.isfile(full_path) else None
+        if overlay is not None:
+            overlay.truncate(length)
+        else:
+            with self.maps_lock:
+                self._unmap_file(os.path.abspath(full_path))
+                with open(full_path, 'r+') as f:
+                    f.truncate(length)
+        cache.drop(os.path.abspath(full_path))
+        self.meta.invalidate(full_path)
+        forget_writes(path, length)
 
     @logs
     def flush(self, path, fh):
+        overlay = self.overlaid.get(fh)
+        if overlay is not None:
+            return overlay.save()
         return os.fsync(fh)
 
     @logs
     def release(self, path, fh):
+        self._unmap(fh)
+        self.names.pop(fh, None)
+        overlay = self.overlaid.pop(fh, None)
+        if overlay is not None:
+            overlay.save()
         return os.close(fh)
 
     @logs
     def fsync(self, path, fdatasync, fh):
         return self.flush(path, fh)
 
+    def destroy(self, path):
+        # Unmounting: drain and commit anything still queued for the loggers
+        close_logging()
+        close_overlays()
+        control.stop()
+
 
 def main(args):
-    FUSE(Passthrough(args.root, args.second_root, args.num_reads), args.mount_point, nothreads=True, foreground=True)
+    # Let the kernel cache attributes and lookups too (libfuse defaults to 1s when not given)
+    timeouts = dict((k, getattr(args, k)) for k in ('attr_timeout', 'entry_timeout', 'negative_timeout')
+                    if getattr(args, k) is not None)
+    FUSE(Passthrough(args.root, args.second_root, args.num_reads, args.mmap, load_images(args), args.meta_ttl,
+                     args.meta_max_entries), args.mount_point, nothreads=not args.threads, foreground=True, **timeouts)
 
 
-if __name__ == '__main__':
+def make_parser():
     argp = argparse.ArgumentParser(description="Perform logging of mass storage operations")
     argp.add_argument('-m', '--mount_point', help="Mount point to use")
     argp.add_argument('-s', '--second_root', default=None, help="Second root to switch to")
@@ -178,15 +376,86 @@ if __name__ == '__main__':
     argp.add_argument('-r', '--root', help="Root to mount at mount point")
     argp.add_argument('-l', '--log_file', default=None, help="Logfile to use.")
     argp.add_argument('-d', '--log_db', default=None, help="Log to an sqlite DB instead")
+    argp.add_argument('-t', '--log_trace', default=None, help="Log to a compact binary trace file")
     argp.add_argument('-a', '--log_all', action="store_true", help="Log everything (DO NOT USE)")
     argp.add_argument('-c', '--call_log', default=['write', 'read'], action='append',
                        help="Use to log only these calls (read, write, etc)")
     argp.add_argument('--log_hash', action="store_true", help="Store a hash of read and write buffers")
     argp.add_argument('--log_bytes', action="store_true", help="Store the full bytes of r/w buffers")
+    argp.add_argument('--hash_algo', default='sha256', choices=['sha256', 'sha1', 'md5', 'blake2b', 'blake2s'],
+                      help="Hash for --log_hash/--log_bytes (per call overrides in the config's db.digests)")
+    argp.add_argument('--compress', default=None, choices=['zlib', 'lzma'],
+                      help="Compress blobs stored with --log_bytes (per call overrides in db.digests)")
+    argp.add_argument('--hash_workers', type=int, default=0,
+                      help="With --log_async, hash and compress on this many worker threads off the FUSE thread")
+    argp.add_argument('--blob_cache_size', type=int, default=4096,
+                      help="Remember this many recently stored blob hashes to skip duplicate --log_bytes inserts")
+    argp.add_argument('--read_count_interval', type=float, default=5.0,
+                      help="Seconds between bulk flushes of the in-memory read_counts histogram")
+    argp.add_argument('--write_diff_block', type=int, default=0,
+                      help="Log only the blocks (of this size) a write changed since the last logged write to them; "
+                           "identical rewrites just count in rewrite_counts (0 logs whole writes)")
+    argp.add_argument('--write_diff_max_blocks', type=int, default=1 << 20,
+                      help="Forget the --write_diff_block index once it holds this many blocks (0 = no cap)")
+    argp.add_argument('--max_read_counts', type=int, default=100000,
+                      help="Flush read_counts early once it holds this many distinct requests (0 = no cap)")
+    argp.add_argument('--max_logged_entries', type=int, default=1000,
+                      help="Keep at most this many entries of a listing (readdir) in its log record")
+    argp.add_argument('--coalesce_ms', type=float, default=0,
+                      help="Merge contiguous reads/writes arriving within this many ms into extent records "
+                           "(0 logs every request); not with --log_bytes, and only reads with --write_diff_block")
+    argp.add_argument('--log_async', action="store_true",
+                      help="Commit DB logs from a background writer thread instead of the FUSE thread")
+    argp.add_argument('--log_queue_size', type=int, default=10000,
+                      help="Max calls waiting for the async DB writer before records are dropped")
+    argp.add_argument('--log_queue_policy', default='drop', choices=QUEUE_POLICIES,
+                      help="When the async DB writer's queue is full: drop the call (counted), make the FUSE "
+                           "thread wait, or spill to <log_db>.spill until the writer catches up")
+    argp.add_argument('--log_batch_size', type=int, default=512, help="Async DB writer commits every N records")
+    argp.add_argument('--log_batch_ms', type=int, default=100, help="... or every T milliseconds")
+    argp.add_argument('--defer_indexes', action="store_true",
+                      help="Build the config's index_creates at flush, segment rotation or unmount instead of up front")
+    argp.add_argument('--db_max_mb', type=int, default=0,
+                      help="Start a new DB segment once the current one reaches this size (0 = never)")
+    argp.add_argument('--db_max_rows', type=int, default=0,
+                      help="... or once this many rows were written to it (0 = never); checked after each "
+                           "commit, so with --log_async a segment can overshoot by up to --log_batch_size calls")
+    argp.add_argument('--fs_index_dir', default=None,
+                      help="Attribute logged reads to files: index the FAT/ext filesystems of each image in the "
+                           "background, keeping the indexes here")
     argp.add_argument('--config', default='config.json', help="Path to a config file")
+    argp.add_argument('--threads', action="store_true", help="Let FUSE serve several requests concurrently")
+    argp.add_argument('--gpt_history', type=int, default=8, help="Number of parsed GPTs to remember")
+    argp.add_argument('--mmap', action="store_true", help="Serve reads from an mmap of the backing image")
+    argp.add_argument('--overlay_dir', default=None,
+                      help="Send writes to copy-on-write overlays in this directory, leaving images untouched")
+    argp.add_argument('--overlay_block_size', type=int, default=4096, help="Overlay block size in bytes")
+    argp.add_argument('--cache_size', type=int, default=0,
+                      help="Bytes of image/replacement file blocks to keep in an LRU cache (0 disables it)")
+    argp.add_argument('--cache_block_size', type=int, default=4096, help="Block cache block size in bytes")
+    argp.add_argument('--meta_ttl', type=float, default=0,
+                      help="Seconds to cache getattr/readdir/access results in process (0 disables the cache)")
+    argp.add_argument('--meta_max_entries', type=int, default=100000,
+                      help="Cap on each --meta_ttl table; past it expired entries are purged (0 = no cap)")
+    argp.add_argument('--attr_timeout', type=float, default=None, help="Seconds the kernel may cache attributes")
+    argp.add_argument('--entry_timeout', type=float, default=None, help="Seconds the kernel may cache name lookups")
+    argp.add_argument('--negative_timeout', type=float, default=None,
+                      help="Seconds the kernel may cache failed lookups")
+    argp.add_argument('--control_socket', default=None,
+                      help="Unix socket answering live commands (e.g. stats); query it with control.py")
+    return argp
+
 
-    args = argp.parse_args()
+if __name__ == '__main__':
+    args = make_parser().parse_args()
+    reload_on_sighup()
+    init_gpt(args)
+    init_overlay(args)
+    cache.init_cache(args)
+    fsindex.init_fsindex(args)
     init_logging(args)
     init_injector(args)
+    if args.control_socket:
+        control.serve(args.control_socket)
 
     main(args)
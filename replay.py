@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Replay the reads and writes of a capture against an image file or a Passthrough.
+
+The offset/length sequence comes from a --log_db capture (its reads and writes tables, merged by
+time) or a --log_trace file. Calls that failed in the capture are skipped (and counted): they
+never did the I/O, so reissuing them would skew the timings. Writes carry their logged bytes when the capture kept them
+(--log_bytes); otherwise a zero-filled buffer of the same length is written. Ops are issued by
+--concurrency threads, either as fast as possible or at the recorded pacing (--speed), and the run
+reports throughput and latency per call as JSON.
+
+  replay.py capture.db --image copy.img --speed 1
+  replay.py capture.db --root images/ -- --log_db /tmp/new.db --overlay_dir /tmp/ov
+"""
+
+import argparse
+import contextlib
+import heapq
+import json
+import lzma
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import export
+import fsindex
+import gpt
+import images
+import injector
+import logger
+import overlay
+import passthrough_logging
+import stats
+import tracefile
+
+DECOMPRESSORS = {None: lambda data: data, 'zlib': zlib.decompress, 'lzma': lzma.decompress}
+
+
+class Op(object):
+    __slots__ = ('time', 'call', 'path', 'offset', 'length', 'data', 'failed')
+
+    def __init__(self, time, call, path, offset, length, data=None, failed=False):
+        self.time = time
+        self.call = call
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.data = data
+        self.failed = failed
+
+
+def db_ops(path, filters=None, chunk_size=10000):
+    """Ops from a capture's reads and writes tables, in recorded order"""
+    def table_ops(table):
+        capture = export.Capture(path, table, filters)
+        names = capture.names
+        if 'time' not in names:
+            raise ValueError("%s has no time column; capture with a newer config to replay it" % table)
+        blobs = {}
+        try:
+            for rows in capture.chunks(chunk_size):
+                for row in rows:
+                    row = dict(zip(names, row))
+                    # Captures made before the state column have no record of failed calls
+                    if row.get('state') == 'error':
+                        yield Op(row['time'], table[:-1], row['path'], row['offset'], 0, failed=True)
+                    elif table == 'reads':
+                        yield Op(row['time'], 'read', row['path'], row['offset'], row['length'])
+                    else:
+                        yield Op(row['time'], 'write', row['path'], row['offset'], row['buffer_length'],
+                                 blob(capture, row['buffer_hash'], blobs))
+        finally:
+            capture.close()
+    return heapq.merge(table_ops('reads'), table_ops('writes'), key=lambda op: op.time or 0)
+
+
+def blob(capture, digest, found, max_found=256):
+    """A write's logged bytes (from whichever segment stored them), or None"""
+    if not digest:
+        return None
+    if digest not in found:
+        if len(found) >= max_found:
+            found.clear()
+        found[digest] = None
+        for conn in capture.conns:
+            try:
+                row = conn.execute("SELECT compression, data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            except sqlite3.OperationalError:
+                row = None
+            if row and row[1]:
+                found[digest] = DECOMPRESSORS[row[0]](row[1])
+                break
+    return found[digest]
+
+
+def trace_ops(path, filters=None):
+    """Ops from the completed reads and writes in a binary trace"""
+    filters = filters or {}
+    for rec in tracefile.read_trace(path):
+        if rec.state not in ('post-run', 'error') or rec.call not in ('read', 'write'):
+            continue
+        if filters.get('path') and rec.path != filters['path']:
+            continue
+        if filters.get('offset_min') is not None and rec.offset < filters['offset_min']:
+            continue
+        if filters.get('offset_max') is not None and rec.offset >= filters['offset_max']:
+            continue
+        if rec.state == 'error':
+            yield Op(rec.time, rec.call, rec.path, rec.offset, 0, failed=True)
+            continue
+        data = tracefile.read_payload(path, rec) if rec.call == 'write' else None
+        yield Op(rec.time, rec.call, rec.path, rec.offset, rec.length if rec.call == 'read' else rec.buffer_length,
+                 data)
+
+
+class ImageTarget(object):
+    """Replays straight against an image file (every path maps to it)"""
+    def __init__(self, image, writable=True):
+        self.fd = os.open(image, os.O_RDWR if writable else os.O_RDONLY)
+
+    def read(self, path, length, offset):
+        return os.pread(self.fd, length, offset)
+
+    def write(self, path, data, offset):
+        return os.pwrite(self.fd, data, offset)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PassthroughTarget(object):
+    """Replays through Passthrough.read/write, with its logging, GPT tracking and injection"""
+    def __init__(self, fs):
+        self.fs = fs
+        self.fhs = {}
+        self.lock = threading.Lock()
+
+    def fh(self, path):
+        fh = self.fhs.get(path)
+        if fh is None:
+            with self.lock:
+                fh = self.fhs.get(path)
+                if fh is None:
+                    fh = self.fhs[path] = self.fs.open(path, os.O_RDWR)
+        return fh
+
+    def read(self, path, length, offset):
+        return self.fs.read(path, length, offset, self.fh(path))
+
+    def write(self, path, data, offset):
+        return self.fs.write(path, data, offset, self.fh(path))
+
+    def close(self):
+        for path, fh in self.fhs.items():
+            self.fs.release(path, fh)
+
+
+class Replayer(object):
+    def __init__(self, target, concurrency=1, speed=0.0, writes=True):
+        self.target = target
+        self.concurrency = max(1, concurrency)
+        # 0 = as fast as possible, 1 = recorded pacing, 2 = twice as fast, ...
+        self.speed = speed
+        self.writes = writes
+        self.lock = threading.Lock()
+        self.latencies = {'read': [], 'write': []}
+        self.bytes = 0
+        self.errors = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def issue(self, op):
+        try:
+            t = time.perf_counter()
+            if op.call == 'read':
+                n = len(self.target.read(op.path, op.length, op.offset))
+            else:
+                n = self.target.write(op.path, op.data or bytes(op.length), op.offset)
+            elapsed = time.perf_counter() - t
+        except Exception as e:
+            with self.lock:
+                self.errors += 1
+            print("Replay %s at %i failed: %s" % (op.call, op.offset, e), file=sys.stderr)
+            return
+        with self.lock:
+            self.latencies[op.call].append(elapsed)
+            self.bytes += n
+
+    def run(self, ops):
+        # Bounded in-flight ops, so a long capture is never read ahead into memory
+        slots = threading.Semaphore(self.concurrency * 2)
+        first = None
+        started = time.perf_counter()
+
+        def done(_):
+            slots.release()
+
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="Replay") as pool:
+            for op in ops:
+                if op.failed:
+                    self.failed += 1
+                    continue
+                if op.call == 'write' and not self.writes:
+                    self.skipped += 1
+                    continue
+                if self.speed and op.time:
+                    first = op.time if first is None else first
+                    delay = started + (op.time - first) / self.speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                slots.acquire()
+                pool.submit(self.issue, op).add_done_callback(done)
+        return self.report(time.perf_counter() - started)
+
+    def report(self, elapsed):
+        ops = sum(len(l) for l in self.latencies.values())
+        result = {'ops': ops, 'seconds': round(elapsed, 6), 'ops_per_s': round(ops / elapsed, 1) if elapsed else 0,
+                  'mb_per_s': round(self.bytes / elapsed / (1 << 20), 2) if elapsed else 0,
+                  'errors': self.errors, 'skipped_writes': self.skipped, 'skipped_failed': self.failed,
+                  'concurrency': self.concurrency, 'speed': self.speed}
+        for call, latencies in self.latencies.items():
+            if latencies:
+                result[call] = dict(stats.summarize(latencies), ops=len(latencies))
+        return result
+
+
+def passthrough_target(root, argv):
+    """A Passthrough set up from passthrough_logging command line arguments, as for a mount"""
+    args = passthrough_logging.make_parser().parse_args(['--root', root] + argv)
+    gpt.init_gpt(args)
+    overlay.init_overlay(args)
+    cache.init_cache(args)
+    fsindex.init_fsindex(args)
+    if args.log_file or args.log_db or args.log_trace:
+        logger.init_logging(args)
+    injector.init_injector(args)
+    fs = passthrough_logging.Passthrough(args.root, args.second_root, args.num_reads, args.mmap,
+                                         images.load_images(args), args.meta_ttl,
+                                         args.meta_max_entries)
+    return PassthroughTarget(fs)
+
+
+def close_passthrough():
+    logger.close_logging()
+    overlay.close_overlays()
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Replay captured I/O against an image or a Passthrough",
+                                   epilog="Arguments after -- configure the Passthrough like passthrough_logging.py")
+    argp.add_argument('capture', help="--log_db capture (or its manifest), or a --log_trace file with --trace")
+    argp.add_argument('--trace', action="store_true", help="The capture is a binary trace")
+    target = argp.add_mutually_exclusive_group(required=True)
+    target.add_argument('--image', help="Replay directly against this image file")
+    target.add_argument('--root', help="Replay through a Passthrough of this root")
+    argp.add_argument('-j', '--concurrency', type=int, default=1, help="Ops in flight at once")
+    argp.add_argument('--speed', type=float, default=0,
+                      help="Pace ops by their recorded times, sped up by this factor (0 = as fast as possible)")
+    argp.add_argument('--no_writes', action="store_true", help="Skip the capture's writes")
+    argp.add_argument('--path', default=None, help="Only replay this path")
+    argp.add_argument('--offset_min', type=int, default=None)
+    argp.add_argument('--offset_max', type=int, default=None)
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        argv, extra = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = argp.parse_args(argv)
+
+    filters = {k: getattr(args, k) for k in ('path', 'offset_min', 'offset_max')}
+    ops = trace_ops(args.capture, filters) if args.trace else db_ops(args.capture, filters)
+    if args.image:
+        tgt = ImageTarget(args.image, writable=not args.no_writes)
+    else:
+        tgt = passthrough_target(args.root, extra)
+    replayer = Replayer(tgt, args.concurrency, args.speed, writes=not args.no_writes)
+    # The result goes to stdout; GPT/injector/logger chatter goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            result = replayer.run(ops)
+        finally:
+            tgt.close()
+            if args.root:
+                close_passthrough()
+    print(json.dumps(result))
@@ -0,0 +1,132 @@
+"""Always-on latency histograms and byte counters, broken down by stage.
+
+Recording is a bit_length() and two integer increments, cheap enough to leave on. Under --threads
+concurrent increments can occasionally be lost; the numbers are for monitoring, not accounting.
+"""
+
+import collections
+import resource
+import time
+
+import control
+
+# Histogram buckets are powers of two of nanoseconds: bucket i holds latencies in [2**(i-1), 2**i)
+NUM_BUCKETS = 48
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+
+    def record(self, ns):
+        self.buckets[min(ns.bit_length(), NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    def percentile(self, q):
+        """Upper bound (in ns) of the bucket holding the q'th quantile"""
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return 1 << i
+        return 0
+
+    def snapshot(self):
+        count = self.count
+        return {'count': count,
+                'mean_us': round(self.total_ns / count / 1e3, 2) if count else 0,
+                'p50_us': self.percentile(0.50) / 1e3,
+                'p99_us': self.percentile(0.99) / 1e3}
+
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = collections.defaultdict(Histogram)
+        self.counters = collections.Counter()
+        # name -> callable returning extra JSON-able stats from other subsystems
+        self.sources = {}
+        # name -> callable returning {'entries', 'bytes' (approximate), 'cap'} for a subsystem's buffers
+        self.memory = {}
+
+    def record(self, stage, ns):
+        self.histograms[stage].record(ns)
+
+    def add(self, counter, n=1):
+        self.counters[counter] += n
+
+    def add_source(self, name, func):
+        self.sources[name] = func
+
+    def add_memory(self, name, func):
+        self.memory[name] = func
+
+    def memory_snapshot(self):
+        subsystems = {name: func() for name, func in list(self.memory.items())}
+        return {'rss_bytes': rss(), 'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss << 10,
+                'tracked_bytes': sum(tracked_bytes(usage) for usage in subsystems.values()),
+                'subsystems': subsystems}
+
+    def snapshot(self):
+        snap = {'uptime_s': round(time.time() - self.started, 3),
+                'latency': {k: v.snapshot() for k, v in list(self.histograms.items())},
+                'counters': dict(self.counters)}
+        for name, func in list(self.sources.items()):
+            snap[name] = func()
+        return snap
+
+
+STATS = Stats()
+now = time.perf_counter_ns
+
+
+def record(stage, ns):
+    STATS.record(stage, ns)
+
+
+def add(counter, n=1):
+    STATS.add(counter, n)
+
+
+@control.command('stats')
+def snapshot():
+    return STATS.snapshot()
+
+
+@control.command('memory')
+def memory():
+    """What each subsystem holds in memory, against its cap, and the process's resident size"""
+    return STATS.memory_snapshot()
+
+
+def rss():
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def tracked_bytes(usage):
+    """Sum of the 'bytes' in a usage dict, or in the usage dicts nested in it"""
+    if not isinstance(usage, dict):
+        return 0
+    if 'bytes' in usage:
+        return usage['bytes'] or 0
+    return sum(tracked_bytes(u) for u in usage.values())
+
+
+def usage(entries, per_entry, cap=None):
+    """A memory report for entries of roughly per_entry bytes each (object and container overhead included)"""
+    return {'entries': entries, 'bytes': entries * per_entry, 'cap': cap}
+
+
+def summarize(latencies):
+    """Exact percentiles (in microseconds) of a list of per-op latencies in seconds"""
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6
+    return {'p50_us': round(pick(0.50), 2), 'p99_us': round(pick(0.99), 2), 'max_us': round(latencies[-1] * 1e6, 2)}
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""Compact binary, append-only trace of logged calls.
+
+A trace is three files:
+  <trace>          16 byte header, then fixed-size struct-packed records (see RECORD)
+  <trace>.names    JSON lines mapping the call/path/partition ids used in records to names
+  <trace>.payload  raw buffers (with --log_bytes); records point at them with payload_ref
+
+The record file is grown in large preallocated steps and written through an in-memory buffer, so
+recording costs a struct.pack_into per call. Unused preallocated space is zeroes (kind 0), which
+readers treat as the end of the trace, so a capture that was never closed is still readable.
+"""
+
+import argparse
+import collections
+import json
+import os
+import struct
+import sys
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'BUSBTRC1'
+HEADER = struct.Struct('<8sII')              # magic, record size, reserved
+RECORD = struct.Struct('<BBHIdQIiI32sQ4x')    # see FIELDS
+FIELDS = ('kind', 'state', 'call_id', 'path_id', 'time', 'offset', 'length', 'partition_id',
+          'buffer_length', 'hash', 'payload_ref')
+
+KIND_END = 0                                  # preallocated, never written
+KIND_CALL = 1
+
+STATES = ('pre-run', 'post-run', 'error')
+NAMESPACES = ('call', 'path', 'partition')
+
+TraceRecord = collections.namedtuple('TraceRecord', ['time', 'call', 'path', 'offset', 'length', 'partition',
+                                                     'state', 'buffer_length', 'hash', 'payload_ref'])
+
+if numpy is not None:
+    DTYPE = numpy.dtype({'names': list(FIELDS),
+                         'formats': ['u1', 'u1', '<u2', '<u4', '<f8', '<u8', '<u4', '<i4', '<u4', 'S32', '<u8'],
+                         'offsets': [0, 1, 2, 4, 8, 16, 24, 28, 32, 36, 68],
+                         'itemsize': RECORD.size})
+
+
+class TraceWriter(object):
+    def __init__(self, path, prealloc=64 << 20, buffer_size=1 << 20):
+        self.path = path
+        self.prealloc = prealloc
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if exists:
+            # Append after the last record written by a previous run
+            self.end = HEADER.size + RECORD.size * count_records(path)
+        else:
+            os.pwrite(self.fd, HEADER.pack(MAGIC, RECORD.size, 0), 0)
+            self.end = HEADER.size
+        self.allocated = os.fstat(self.fd).st_size
+        self.buffer = bytearray(buffer_size + RECORD.size)
+        self.buffered = 0
+
+        self.names_fh = open(path + '.names', 'a')
+        self.ids = {ns: {} for ns in NAMESPACES}
+        for ns, id_, name in read_names(path):
+            self.ids[ns][name] = id_
+        self.payload_fh = None
+
+    def name_id(self, namespace, name):
+        ids = self.ids[namespace]
+        id_ = ids.get(name)
+        if id_ is None:
+            with self.lock:
+                id_ = ids.get(name)
+                if id_ is None:
+                    id_ = ids[name] = len(ids)
+                    self.names_fh.write(json.dumps([namespace, id_, name]) + '\n')
+                    self.names_fh.flush()
+        return id_
+
+    def payload(self, data):
+        """Append a buffer to the payload file, returning its reference (offset + 1)"""
+        with self.lock:
+            if self.payload_fh is None:
+                self.payload_fh = open(self.path + '.payload', 'ab')
+            ref = self.payload_fh.tell() + 1
+            self.payload_fh.write(data)
+        return ref
+
+    def append(self, state, call_id, path_id, timestamp, offset, length, partition_id, buffer_length,
+               digest=b'', payload_ref=0):
+        with self.lock:
+            RECORD.pack_into(self.buffer, self.buffered, KIND_CALL, state, call_id, path_id, timestamp, offset,
+                             length, partition_id, buffer_length, digest, payload_ref)
+            self.buffered += RECORD.size
+            if self.buffered >= self.buffer_size:
+                self._flush()
+
+    def _flush(self):
+        if not self.buffered:
+            return
+        needed = self.end + self.buffered
+        if needed > self.allocated:
+            # Whole records only, so the file always maps cleanly onto DTYPE
+            self.allocated = needed + self.prealloc // RECORD.size * RECORD.size
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd, 0, self.allocated)
+            else:
+                os.ftruncate(self.fd, self.allocated)
+        os.pwrite(self.fd, memoryview(self.buffer)[:self.buffered], self.end)
+        self.end = needed
+        self.buffered = 0
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+            if self.payload_fh:
+                self.payload_fh.flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            # Give back the unused preallocation
+            os.ftruncate(self.fd, self.end)
+            os.close(self.fd)
+            self.names_fh.close()
+            if self.payload_fh:
+                self.payload_fh.close()
+
+
+def read_names(path):
+    """(namespace, id, name) for every name defined in a trace"""
+    if not os.path.exists(path + '.names'):
+        return
+    with open(path + '.names') as fh:
+        for line in fh:
+            if line.strip():
+                yield tuple(json.loads(line))
+
+
+def _check_header(fh):
+    magic, record_size, _ = HEADER.unpack(fh.read(HEADER.size))
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("Not a trace file (or an incompatible version): %r" % magic)
+
+
+def iter_raw(path, chunk_records=4096):
+    """Yield each record as a raw tuple of FIELDS, reading chunk_records at a time"""
+    with open(path, 'rb') as fh:
+        _check_header(fh)
+        while True:
+            chunk = fh.read(RECORD.size * chunk_records)
+            for record in RECORD.iter_unpack(chunk[:len(chunk) - len(chunk) % RECORD.size]):
+                if record[0] == KIND_END:
+                    return
+                yield record
+            if len(chunk) < RECORD.size * chunk_records:
+                return
+
+
+def count_records(path):
+    """Number of records, found by bisecting for the first unwritten (kind 0) slot"""
+    with open(path, 'rb') as fh:
+        _check_header(fh)
+        lo, hi = 0, (os.fstat(fh.fileno()).st_size - HEADER.size) // RECORD.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            fh.seek(HEADER.size + mid * RECORD.size)
+            if fh.read(1) == b'\0':
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+
+def read_trace(path, chunk_records=4096):
+    """Stream a trace as TraceRecords with ids resolved to names"""
+    names = {ns: {} for ns in NAMESPACES}
+    for ns, id_, name in read_names(path):
+        names[ns][id_] = name
+    calls, paths, partitions = names['call'], names['path'], names['partition']
+    for (_, state, call_id, path_id, timestamp, offset, length, partition_id, buffer_length, digest,
+         payload_ref) in iter_raw(path, chunk_records):
+        yield TraceRecord(timestamp, calls.get(call_id), paths.get(path_id), offset, length,
+                          partitions.get(partition_id) if partition_id >= 0 else None, STATES[state],
+                          buffer_length, digest.hex() if digest.strip(b'\0') else None, payload_ref)
+
+
+def read_payload(path, record):
+    """The logged buffer for a record, or None if its bytes weren't kept"""
+    if not record.payload_ref:
+        return None
+    with open(path + '.payload', 'rb') as fh:
+        fh.seek(record.payload_ref - 1)
+        return fh.read(record.buffer_length)
+
+
+def read_trace_array(path):
+    """The whole trace as a NumPy structured array (memory mapped), for vectorized analysis"""
+    if numpy is None:
+        raise ImportError("read_trace_array needs numpy")
+    count = count_records(path)
+    if not count:
+        return numpy.zeros(0, dtype=DTYPE)
+    return numpy.memmap(path, dtype=DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description="Dump a binary trace as JSON lines")
+    argp.add_argument('trace', help="Trace file written with --log_trace")
+    args = argp.parse_args()
+    for rec in read_trace(args.trace):
+        sys.stdout.write(json.dumps(rec._asdict()) + '\n')